@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import KEprocessing, KEstream
+
+HOUR_COLUMNS = KEprocessing.HOUR_COLUMNS
+
+
+def reference_replace_invalid_with_row_mean(df, residential_threshold, commercial_threshold, min_non_nan=3):
+    # The original apply/map implementation, kept as the reference the vectorized one must match exactly
+    hour_columns = [f'HOUR_{i}' for i in range(24)]
+    df_filtered = df.dropna(thresh=min_non_nan, subset=hour_columns)
+    thresholds = df_filtered['ISPRIVATEPERSON'].map(lambda x: residential_threshold if x == 'Ja' else commercial_threshold)
+    df_filtered[hour_columns] = df_filtered[hour_columns].mask((df_filtered[hour_columns] < 0) | (df_filtered[hour_columns].gt(thresholds, axis=0)))
+    row_means = df_filtered[hour_columns].mean(axis=1)
+    df_filtered[hour_columns] = df_filtered[hour_columns].apply(lambda x: x.fillna(row_means[x.name]), axis=1)
+    return df_filtered
+
+
+def meter_frame(n_rows=2_000, seed=0):
+    # Daily meter rows like consolidate_data returns, with missing, negative and too large readings, rows
+    # below min_non_nan and rows where every reading is invalid
+    rng = np.random.default_rng(seed)
+    customer_types = rng.choice(['Ja', 'Nej'], n_rows)
+    scale = np.where(customer_types == 'Ja', 0.04, 4.0)[:, None]
+    values = rng.random((n_rows, 24)) * scale
+    values[rng.random((n_rows, 24)) < 0.1] = np.nan
+    values[rng.random((n_rows, 24)) < 0.02] *= -1
+    values[::50, :22] = np.nan
+    values[7::50] = -1.0
+    df = pd.DataFrame({'CUSTOMER': rng.integers(10**9, 2 * 10**9, n_rows), 'AREA': rng.choice(['Kalmar', 'Smedby'], n_rows),
+                       'ISPRIVATEPERSON': customer_types, 'DATE': pd.Timestamp('2021-01-01')})
+    df[HOUR_COLUMNS] = values
+    df['YEAR'] = '2021'
+    return df
+
+
+@pytest.mark.parametrize('chunk_size', [None, 1, 333, 5_000])
+def test_matches_reference(chunk_size):
+    df = meter_frame()
+    expected = reference_replace_invalid_with_row_mean(df.copy(), 0.03, 3, 3)
+    result = KEprocessing.replace_invalid_with_row_mean(df, 0.03, 3, 3, chunk_size=chunk_size)
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
+
+
+def test_integer_hours_stay_float():
+    df = meter_frame(200)
+    df[HOUR_COLUMNS] = (df[HOUR_COLUMNS].fillna(1) * 10).astype(np.int64)
+    expected = reference_replace_invalid_with_row_mean(df.copy(), 1, 20, 3)
+    result = KEprocessing.replace_invalid_with_row_mean(df, 1, 20, 3, chunk_size=64)
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
+    assert (result[HOUR_COLUMNS].dtypes == np.float64).all()
+
+
+def test_missing_hour_column_raises():
+    df = meter_frame(50).drop(columns='HOUR_5')
+    with pytest.raises(KeyError, match='HOUR_5'):
+        KEprocessing.replace_invalid_with_row_mean(df, 0.03, 3, 3, chunk_size=16)
+
+
+def test_streaming_matches_batch():
+    # meter_frame has rows below min_non_nan (dropped) and rows where every reading is invalid (left NaN)
+    df = meter_frame()
+    expected = KEprocessing.replace_invalid_with_row_mean(df, 0.03, 3, 3)
+    result = KEstream.replace_invalid_streaming(df, 0.03, 3, 3)
+    assert len(result) < len(df) and result[HOUR_COLUMNS].isna().all(axis=1).any()
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
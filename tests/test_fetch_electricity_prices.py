@@ -0,0 +1,87 @@
+import asyncio
+import csv
+from datetime import date
+
+import pytest
+
+httpx = pytest.importorskip('httpx')
+
+from utils import fetch_electricity_prices
+
+DAYS = [date(2023, 1, 1), date(2023, 1, 2), date(2023, 1, 3)]
+
+
+def day_prices(day, region):
+    # Two hours of an elprisetjustnu day, the price tells region and day apart
+    return [{'SEK_per_kWh': float(day.day), 'EUR_per_kWh': float(day.day) / 10, 'EXR': 10.0,
+             'time_start': f'{day.isoformat()}T{hour:02d}:00:00+01:00',
+             'time_end': f'{day.isoformat()}T{hour + 1:02d}:00:00+01:00', 'region_code': region}
+            for hour in range(2)]
+
+
+def fetch(tmp_path, handler, regions=('SE4',), retries=2):
+    # Run the fetcher over DAYS against handler, returns (rows, failures, CSV rows)
+    output_path = tmp_path / 'prices.csv'
+    rows, failures = asyncio.run(fetch_electricity_prices.fetch_prices(
+        list(regions), DAYS[0], DAYS[-1], str(output_path), retries=retries, backoff=0,
+        transport=httpx.MockTransport(handler)))
+    with open(output_path, 'r', encoding='utf-8', newline='') as file:
+        return rows, failures, list(csv.DictReader(file))
+
+
+def request_day_region(request):
+    # .../prices/2023/01-02_SE4.json
+    *_, year, name = request.url.path.split('/')
+    month_day, region = name[:-len('.json')].split('_')
+    month, day = month_day.split('-')
+    return date(int(year), int(month), int(day)), region
+
+
+def test_retries_unavailable_then_succeeds(tmp_path):
+    calls = {}
+
+    def handler(request):
+        day, region = request_day_region(request)
+        calls[day] = calls.get(day, 0) + 1
+        if calls[day] < 3:
+            return httpx.Response(503)
+        return httpx.Response(200, json=day_prices(day, region))
+
+    rows, failures, written = fetch(tmp_path, handler)
+    assert failures == []
+    assert all(count == 3 for count in calls.values())
+    assert rows == len(written) == 2 * len(DAYS)
+
+
+def test_not_found_day_is_reported_and_others_kept(tmp_path):
+    calls = []
+
+    def handler(request):
+        day, region = request_day_region(request)
+        calls.append(day)
+        if day == DAYS[1]:
+            return httpx.Response(404)
+        return httpx.Response(200, json=day_prices(day, region))
+
+    rows, failures, written = fetch(tmp_path, handler)
+    assert [(region, day) for region, day, _ in failures] == [('SE4', DAYS[1].isoformat())]
+    assert '404' in failures[0][2]
+    # A 404 is not retried
+    assert calls.count(DAYS[1]) == 1
+    assert rows == len(written) == 4
+    assert {row['timestamp'][:10] for row in written} == {DAYS[0].isoformat(), DAYS[2].isoformat()}
+
+
+def test_rows_of_all_regions_are_written(tmp_path):
+    regions = ['SE1', 'SE2', 'SE3', 'SE4']
+
+    def handler(request):
+        return httpx.Response(200, json=day_prices(*request_day_region(request)))
+
+    rows, failures, written = fetch(tmp_path, handler, regions)
+    assert failures == []
+    assert rows == len(written) == 2 * len(DAYS) * len(regions)
+    assert {(row['region'], row['timestamp'][:10]) for row in written} == {
+        (region, day.isoformat()) for region in regions for day in DAYS}
+    # time_start becomes timestamp and time_end is dropped, like get_electricity_prices.py
+    assert 'time_end' not in written[0] and 'time_start' not in written[0]
@@ -0,0 +1,174 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import pickle
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import KEfeatures, KEtraining
+
+# Rolling-origin backtests of the model families in KEtraining on one daily model frame. All models
+# are scored on the same folds, every (model, parameters, fold) fit runs as its own task in a process
+# pool, and each successful fit is memoized under a hash of the data, model, parameters and fold (the
+# metrics as <key>.json, the fitted model as <key>.pkl), so running a comparison again only fits what
+# changed. Failed fits are not cached, they are tried again on the next run (e.g. once a missing
+# library is installed)
+
+CACHE_DIR = 'data/backtest_cache'
+
+logger = logging.getLogger(__name__)
+
+METRICS = ['MSE', 'RMSE', 'MAE', 'MAPE']
+
+# Display names used in PerformanceParametrs.xlsx
+MODEL_NAMES = {'random_forest': 'Random Forest', 'xgboost': 'XGBoost', 'sarimax': 'ARIMAX',
+               'prophet': 'FB Prophet', 'cnn': 'CNN'}
+
+
+def grid(**candidates):
+    # All combinations of the given candidate lists, like GridSearchCV's param_grid
+    names = list(candidates)
+    return [dict(zip(names, values)) for values in itertools.product(*candidates.values())]
+
+
+# Candidates taken from the grids and settings in the modelling notebooks
+DEFAULT_CANDIDATES = {
+    'sarimax': [{'order': (0, 1, 1), 'seasonal_order': (1, 1, 1, 7), 'exog': ['Price', 'Dew Point Temperature_P39']}],
+    'xgboost': [{'model_params': {**params, 'n_jobs': 1}}
+                for params in grid(n_estimators=[50, 500], max_depth=[1, 15], learning_rate=[0.1, 0.2, 0.3, 0.4])],
+    'random_forest': [{'model_params': {**params, 'min_samples_split': 2, 'min_samples_leaf': 2, 'n_jobs': 1}}
+                      for params in grid(max_depth=list(range(3, 10)), n_estimators=list(range(50, 250, 50)))],
+    'prophet': [{'regressors': ['Price', 'Dew Point Temperature_P39']}],
+    'cnn': [{'look_back': 10, 'features': ['Price', 'Dew Point Temperature_P39']}],
+}
+
+
+def rolling_origin_folds(n_rows, horizon=60, n_folds=5, step=None, window='expanding', train_size=None):
+    # (train_start, train_end, test_end) row positions of each fold, oldest first. The last fold tests
+    # on the final `horizon` rows like temporal_train_test_split(y, test_size=horizon). With
+    # window='sliding' every training window has train_size rows, by default as many as the first
+    # fold has, otherwise it grows from row 0
+    step = horizon if step is None else step
+    if window not in ('expanding', 'sliding'):
+        raise ValueError(f"window must be 'expanding' or 'sliding', got {window!r}")
+    if window == 'sliding' and train_size is None:
+        train_size = n_rows - (n_folds - 1) * step - horizon
+        if train_size <= 0:
+            raise ValueError(f'{n_rows} rows leave no training data for {n_folds} folds of horizon {horizon}')
+    folds = []
+    for fold in range(n_folds):
+        test_end = n_rows - (n_folds - 1 - fold) * step
+        train_end = test_end - horizon
+        train_start = 0 if window == 'expanding' else max(0, train_end - train_size)
+        if train_end - train_start > 0:
+            folds.append((train_start, train_end, test_end))
+    return folds
+
+
+def _result_key(frame_hash, model, params, fold):
+    payload = json.dumps([frame_hash, model, params, list(fold)], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:20]
+
+
+def _model_path(result_path):
+    model_path = result_path[:-len('.json')] + '.pkl'
+    return model_path if os.path.exists(model_path) else None
+
+
+def load_fold_model(model_path):
+    # The fitted model of a backtest result row (its model_path column)
+    with open(model_path, 'rb') as file:
+        return pickle.load(file)
+
+
+def _run_fold(model, params, train, test, result_path):
+    # Runs in a worker process, failures are returned as results so one bad fit does not stop the run.
+    # Only successful results are written to the cache
+    try:
+        fitted, predictions = KEtraining.MODEL_FAMILIES[model](train, test, params)
+        result = {'status': 'ok', **KEtraining.forecast_metrics(test[KEfeatures.TARGET], predictions)}
+    except Exception as error:
+        return {'status': 'failed', 'error': f'{type(error).__name__}: {error}'}
+
+    # The model goes first, so a cached result always has its model next to it. Models that cannot
+    # be pickled keep only their metrics
+    model_path = result_path[:-len('.json')] + '.pkl'
+    try:
+        with open(model_path + '.tmp', 'wb') as file:
+            pickle.dump(fitted, file)
+        os.replace(model_path + '.tmp', model_path)
+    except Exception as error:
+        logger.warning('Could not save the %s model: %s', model, error)
+
+    with open(result_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(result, file, default=float)
+    os.replace(result_path + '.tmp', result_path)
+    return result
+
+
+def backtest(daily, candidates=None, horizon=60, n_folds=5, step=None, window='expanding', train_size=None,
+             max_workers=None, cache_dir=CACHE_DIR, output_path=None, metric='RMSE'):
+    # daily is a daily model frame (KEfeatures.daily_model_frame). candidates maps model family to a
+    # list of parameter dicts. Returns one row per (model, params, fold). With output_path the
+    # performance_table of the run is written there as well
+    candidates = DEFAULT_CANDIDATES if candidates is None else candidates
+    folds = rolling_origin_folds(len(daily), horizon, n_folds, step, window, train_size)
+    if not folds:
+        raise ValueError(f'{len(daily)} rows are too few for a fold of horizon {horizon}')
+    frame_hash = KEtraining.data_hash(daily)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for model, parameter_sets in candidates.items():
+            for params in parameter_sets:
+                for fold_number, fold in enumerate(folds):
+                    row = {'model': model, 'params': json.dumps(params, sort_keys=True, default=str),
+                           'fold': fold_number, 'train_start': daily.index[fold[0]],
+                           'test_start': daily.index[fold[1]], 'test_end': daily.index[fold[2] - 1]}
+                    result_path = os.path.join(cache_dir, _result_key(frame_hash, model, params, fold) + '.json')
+                    if os.path.exists(result_path):
+                        with open(result_path, 'r', encoding='utf-8') as file:
+                            cached = json.load(file)
+                        # Failures left in the cache by earlier runs are fitted again
+                        if cached['status'] == 'ok':
+                            rows.append({**row, **cached, 'cached': True, 'model_path': _model_path(result_path)})
+                            continue
+                    train, test = daily.iloc[fold[0]:fold[1]], daily.iloc[fold[1]:fold[2]]
+                    futures[executor.submit(_run_fold, model, params, train, test, result_path)] = row, result_path
+
+        for future in as_completed(futures):
+            row, result_path = futures[future]
+            rows.append({**row, **future.result(), 'cached': False, 'model_path': _model_path(result_path)})
+
+    results = pd.DataFrame(rows).sort_values(['model', 'params', 'fold']).reset_index(drop=True)
+    if output_path is not None:
+        performance_table(results, metric, output_path)
+    return results
+
+
+def summarize(results, metric='RMSE'):
+    # Mean metrics over the folds for every (model, params), best parameters per model first. The metric
+    # columns are missing when no fit succeeded (e.g. prophet not installed), the summary is empty then
+    ok = results[results['status'] == 'ok'].reindex(columns=results.columns.union(METRICS, sort=False))
+    summary = ok.groupby(['model', 'params'])[METRICS].mean()
+    summary['folds'] = ok.groupby(['model', 'params']).size()
+    return summary.reset_index().sort_values(['model', metric]).reset_index(drop=True)
+
+
+def performance_table(results, metric='RMSE', output_path=None):
+    # Metrics as rows and the best parameter set of each model as a column, the layout of
+    # PerformanceParametrs.xlsx. Written to output_path (.xlsx or .csv) if given
+    best = summarize(results, metric).groupby('model').head(1)
+    table = best.set_index('model')[METRICS].T.round(2)
+    table.columns = [MODEL_NAMES.get(model, model) for model in table.columns]
+
+    if output_path is not None:
+        if output_path.endswith('.xlsx'):
+            table.to_excel(output_path)
+        else:
+            table.to_csv(output_path)
+    return table
@@ -0,0 +1,221 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import threading
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from utils import KEinstrument, KEprocessing, KEsynthetic, get_weather_parameters, merge_weather_parameters
+
+# Wall time and peak memory of the KEprocessing stages on synthetic data of increasing size. Every
+# run appends one JSON line per (size, stage) to data/benchmarks/results.jsonl together with the git
+# commit and library versions, so runs on different commits can be compared with compare_runs.
+# Sizes are daily meter rows, the long and final stages have 24 times as many rows.
+#
+#   python -m utils.KEbenchmark --sizes 10000 100000 1000000 10000000
+BENCHMARK_DIR = 'data/benchmarks'
+SYNTHETIC_DIR = 'data/synthetic'
+RESULTS_PATH = os.path.join(BENCHMARK_DIR, 'results.jsonl')
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+YEARS = [2020, 2021, 2022, 2023]
+
+logger = logging.getLogger(__name__)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _children_rss_mb():
+    # Summed resident memory of the live child processes, e.g. the workers of the parallel consolidate.
+    # None where /proc is not available
+    try:
+        pids = set()
+        for task in os.listdir('/proc/self/task'):
+            with open(f'/proc/self/task/{task}/children', 'r') as file:
+                pids.update(file.read().split())
+    except OSError:
+        return None
+    rss_kb = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status', 'r') as file:
+                rss_kb += next((int(line.split()[1]) for line in file if line.startswith('VmRSS:')), 0)
+        except OSError:
+            # The worker exited between the listing and the read
+            continue
+    return rss_kb / 1024
+
+
+class _ChildrenPeak:
+    # Samples _children_rss_mb in a background thread while a stage runs and keeps the maximum
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_mb = _children_rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while self.peak_mb is not None and not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, _children_rss_mb() or 0.0)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def measure(function, *args, trace_memory=True, **kwargs):
+    # Returns (result, seconds, peak MB, worker peak MB). The time is taken on a run without tracemalloc,
+    # which slows allocations down; the peaks come from a second run with tracing on when trace_memory is
+    # set. tracemalloc only sees the parent process, so the memory of worker processes is sampled
+    # separately as their summed RSS (0 for stages without workers)
+    gc.collect()
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - started
+
+    peak_mb = worker_peak_mb = None
+    if trace_memory:
+        del result
+        gc.collect()
+        tracemalloc.start()
+        with _ChildrenPeak() as children:
+            result = function(*args, **kwargs)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+        worker_peak_mb = children.peak_mb
+    return result, seconds, peak_mb, worker_peak_mb
+
+
+def synthetic_dataset(n_rows, years=YEARS, synthetic_dir=SYNTHETIC_DIR, seed=0):
+    # Generate the synthetic files for a size once and reuse them on later runs
+    data_dir = os.path.join(synthetic_dir, str(n_rows))
+    power_paths = [os.path.join(data_dir, f'lnu_{year}.csv') for year in years]
+    if not all(os.path.exists(path) for path in power_paths):
+        KEsynthetic.generate_dataset(data_dir, KEsynthetic.customers_for_rows(n_rows, years), years, seed=seed)
+    price_paths = [os.path.join(data_dir, f'electricity_prices_{year}.csv') for year in years]
+    return data_dir, power_paths, price_paths
+
+
+def weather_frame(data_dir, years=YEARS):
+    # Wide hourly weather table built from the synthetic SMHI files, the way the weather scripts do
+    parameters = merge_weather_parameters.parameters
+    with KEinstrument.working_directory(data_dir):
+        yearly_frames = {parameter: get_weather_parameters.process_parameter(parameter, years) for parameter in parameters}
+    weather_df, _ = merge_weather_parameters.merge_weather_parameters(parameters, years, yearly_frames)
+    return weather_df
+
+
+def run_size(n_rows, years=YEARS, trace_memory=True, parallel=False, synthetic_dir=SYNTHETIC_DIR):
+    # Benchmark every stage on one size. Each stage takes the previous stage's output as input
+    data_dir, power_paths, price_paths = synthetic_dataset(n_rows, years, synthetic_dir)
+    records = []
+
+    def record(stage, rows_in, result, seconds, peak_mb, worker_peak_mb):
+        # peak_mb is the parent process only, worker_peak_mb the summed RSS of the worker processes
+        rows_out = len(result[0] if isinstance(result, tuple) else result)
+        records.append({'stage': stage, 'rows': n_rows, 'rows_in': rows_in, 'rows_out': rows_out,
+                        'seconds': round(seconds, 4), 'peak_mb': None if peak_mb is None else round(peak_mb, 1),
+                        'worker_peak_mb': None if worker_peak_mb is None else round(worker_peak_mb, 1)})
+        memory = '' if peak_mb is None else f'{peak_mb:10.1f} MB'
+        if worker_peak_mb:
+            memory += f' + {worker_peak_mb:.1f} MB in workers'
+        logger.info('%10d %-34s %9.2fs %s', n_rows, stage, seconds, memory)
+
+    combined_df, *measured = measure(KEprocessing.consolidate_data, power_paths, 'power', trace_memory=trace_memory)
+    record('consolidate_data', len(combined_df), combined_df, *measured)
+
+    if parallel:
+        result, *measured = measure(KEprocessing.consolidate_data, power_paths, 'power', parallel=True,
+                                    trace_memory=trace_memory)
+        record('consolidate_data[parallel]', len(result), result, *measured)
+        del result
+
+    combined_df['One_Day_Power'] = combined_df[KEprocessing.HOUR_COLUMNS].sum(axis=1)
+    combined_df['One_Day_Power_NaN'] = combined_df[KEprocessing.HOUR_COLUMNS].isna().sum(axis=1)
+    cleaned_df, *measured = measure(KEprocessing.replace_invalid_with_row_mean, combined_df, 0.03, 3,
+                                    trace_memory=trace_memory)
+    record('replace_invalid_with_row_mean', len(combined_df), cleaned_df, *measured)
+    del combined_df
+
+    long_df, *measured = measure(KEprocessing.reshape_power_df, cleaned_df, output_path=None, trace_memory=trace_memory)
+    record('reshape_power_df', len(cleaned_df), long_df, *measured)
+    del cleaned_df
+
+    price_df = KEprocessing.consolidate_data(price_paths, 'price')
+    weather_df = weather_frame(data_dir, years)
+    for how in ['outer', 'star']:
+        result, *measured = measure(KEprocessing.merge_weather_price, long_df, weather_df, price_df,
+                                    output_path=None, how=how, dimension_path=None, trace_memory=trace_memory)
+        record(f'merge_weather_price[{how}]', len(long_df), result, *measured)
+        del result
+
+    return records
+
+
+def run_benchmarks(sizes=None, years=YEARS, trace_memory=True, parallel=False, results_path=RESULTS_PATH,
+                   synthetic_dir=SYNTHETIC_DIR):
+    # Run all sizes and append the records to results_path. Returns this run's records as a DataFrame
+    sizes = DEFAULT_SIZES if sizes is None else sizes
+    run = {'run_at': pd.Timestamp.now().isoformat(timespec='seconds'), 'commit': _git_commit(),
+           'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+           'trace_memory': trace_memory}
+
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    records = []
+    for n_rows in sizes:
+        size_records = [{**run, **record} for record in run_size(n_rows, years, trace_memory, parallel, synthetic_dir)]
+        # Written after every size so a run that dies at a large size keeps the smaller ones
+        with open(results_path, 'a', encoding='utf-8') as file:
+            for record in size_records:
+                file.write(json.dumps(record) + '\n')
+        records.extend(size_records)
+
+    return pd.DataFrame(records)
+
+
+def load_results(results_path=RESULTS_PATH):
+    return pd.read_json(results_path, lines=True)
+
+
+def compare_runs(results=None, baseline=None, current=None, metric='seconds'):
+    # metric per (stage, rows) for two runs side by side, identified by their run_at, by default the
+    # last two runs. ratio < 1 means the current run is faster (or smaller)
+    results = load_results() if results is None else results
+    results = results.assign(run_at=results['run_at'].astype(str))
+    runs = sorted(results['run_at'].unique())
+    current = runs[-1] if current is None else current
+    baseline = runs[max(runs.index(current) - 1, 0)] if baseline is None else baseline
+
+    latest = results.groupby(['run_at', 'stage', 'rows'])[metric].last()
+    table = pd.DataFrame({'baseline': latest.loc[baseline], 'current': latest.loc[current]})
+    table['ratio'] = table['current'] / table['baseline']
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the KEprocessing stages on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Daily meter rows per run')
+    parser.add_argument('--years', type=int, nargs='+', default=YEARS)
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc run of each stage')
+    parser.add_argument('--parallel', action='store_true', help='Also time the parallel consolidate_data')
+    parser.add_argument('--results', default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    run_benchmarks(args.sizes, args.years, not args.no_memory, args.parallel, args.results)
+    logger.info('%s', compare_runs(load_results(args.results)))
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import shutil
+import pandas as pd
+
+from utils import KEprocessing, KEschema
+
+# Every stage is stored as data/cache/<stage>/<key>/YEAR=<year>/ISPRIVATEPERSON=<type>/part.parquet
+# plus a manifest.json that is written last and marks the stage as complete. The key is a hash
+# of the stage's input files (by content) and parameters, so a stage is rebuilt only when they change
+CACHE_DIR = 'data/cache'
+PARTITION_COLUMNS = ['YEAR', 'ISPRIVATEPERSON']
+POWER_FILENAMES = ['data/lnu_2020.csv', 'data/lnu_2021.csv', 'data/lnu_2022.csv', 'data/lnu_2023.csv']
+PRICE_FILENAMES = ['data/electricity_prices_2020.csv', 'data/electricity_prices_2021.csv',
+                   'data/electricity_prices_2022.csv', 'data/electricity_prices_2023.csv']
+WEATHER_PATH = 'final_combined_weather_data.csv'
+
+
+def file_fingerprint(path, cache_dir=CACHE_DIR):
+    # SHA-256 of the file contents. Hashes are remembered per (size, mtime) so an unchanged
+    # file is only read once
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    hashes_path = os.path.join(cache_dir, 'file_hashes.json')
+    hashes = {}
+    if os.path.exists(hashes_path):
+        with open(hashes_path, 'r', encoding='utf-8') as file:
+            hashes = json.load(file)
+
+    known = hashes.get(path)
+    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+        return known['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+
+    hashes[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(hashes_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(hashes, file)
+    os.replace(hashes_path + '.tmp', hashes_path)
+
+    return digest.hexdigest()
+
+
+def stage_key(stage, inputs, params, cache_dir=CACHE_DIR):
+    # Inputs are either file paths (hashed by content) or keys of upstream stages
+    resolved = [file_fingerprint(item, cache_dir) if os.path.isfile(item) else str(item) for item in inputs]
+    payload = json.dumps({'stage': stage, 'inputs': resolved, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def _stage_dir(stage, key, cache_dir):
+    return os.path.join(cache_dir, stage, key)
+
+
+def _read_manifest(stage, key, cache_dir):
+    manifest_path = os.path.join(_stage_dir(stage, key, cache_dir), 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def has_stage(stage, key, cache_dir=CACHE_DIR):
+    return _read_manifest(stage, key, cache_dir) is not None
+
+
+def _partition_values(df):
+    # YEAR comes from the frame if present, otherwise from the DateTime column of the long frames
+    if 'YEAR' in df.columns:
+        years = df['YEAR'].astype(str)
+    else:
+        years = pd.to_datetime(df['DateTime']).dt.year.astype('Int64').astype(str)
+    # Compact frames (boolean customer type) use the same 'Ja'/'Nej' partitions
+    labels = pd.Series(KEschema.customer_type_labels(df['ISPRIVATEPERSON']), index=df.index)
+    customer_types = labels.where(labels.notna(), 'None').astype(str)
+    return years, customer_types
+
+
+def write_stage(df, stage, key, params=None, inputs=None, cache_dir=CACHE_DIR):
+    stage_dir = _stage_dir(stage, key, cache_dir)
+    # Remove what a crashed earlier write may have left behind
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    os.makedirs(stage_dir)
+
+    years, customer_types = _partition_values(df)
+    partitions = []
+    for (year, customer_type), part in df.groupby([years, customer_types], sort=True):
+        part_dir = os.path.join(stage_dir, f'YEAR={year}', f'ISPRIVATEPERSON={customer_type}')
+        os.makedirs(part_dir)
+        part.to_parquet(os.path.join(part_dir, 'part.parquet'), index=True)
+        partitions.append({'YEAR': year, 'ISPRIVATEPERSON': customer_type,
+                           'path': os.path.relpath(os.path.join(part_dir, 'part.parquet'), stage_dir),
+                           'rows': len(part)})
+
+    manifest = {'stage': stage, 'key': key, 'params': params, 'inputs': inputs,
+                'columns': [str(column) for column in df.columns], 'partitions': partitions}
+    manifest_path = os.path.join(stage_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, default=str)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def read_stage(stage, key, columns=None, years=None, customer_types=None, cache_dir=CACHE_DIR):
+    # Load only the requested partitions and columns. Rows come back in their original order
+    manifest = _read_manifest(stage, key, cache_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No cached '{stage}' stage with key {key} in {cache_dir}")
+
+    years = None if years is None else {str(year) for year in years}
+    customer_types = None if customer_types is None else {str(customer_type) for customer_type in customer_types}
+
+    parts = []
+    for partition in manifest['partitions']:
+        if years is not None and partition['YEAR'] not in years:
+            continue
+        if customer_types is not None and partition['ISPRIVATEPERSON'] not in customer_types:
+            continue
+        parts.append(pd.read_parquet(os.path.join(_stage_dir(stage, key, cache_dir), partition['path']), columns=columns))
+
+    if not parts:
+        first = manifest['partitions'][0]['path'] if manifest['partitions'] else None
+        if first is None:
+            return pd.DataFrame(columns=columns or manifest['columns'])
+        return pd.read_parquet(os.path.join(_stage_dir(stage, key, cache_dir), first), columns=columns).iloc[:0]
+
+    return pd.concat(parts).sort_index(kind='stable')
+
+
+def cached_stage(stage, build, inputs, params, cache_dir=CACHE_DIR):
+    # Return the stage key, building and storing the stage first if it is not cached yet
+    key = stage_key(stage, inputs, params, cache_dir)
+    if not has_stage(stage, key, cache_dir):
+        write_stage(build(), stage, key, params, list(inputs), cache_dir)
+    return key
+
+
+def combined_df_noNA_key(filenames=None, residential_threshold=0.03, commercial_threshold=3, min_non_nan=3, cache_dir=CACHE_DIR):
+    filenames = filenames or POWER_FILENAMES
+    params = {'residential_threshold': residential_threshold, 'commercial_threshold': commercial_threshold,
+              'min_non_nan': min_non_nan}
+    build = lambda: KEprocessing.prepare_final_df(filenames, residential_threshold, commercial_threshold, min_non_nan, output_path=None)
+    return cached_stage('combined_df_noNA', build, filenames, params, cache_dir)
+
+
+def combined_df_long_key(noNA_key, cache_dir=CACHE_DIR):
+    build = lambda: KEprocessing.reshape_power_df(read_stage('combined_df_noNA', noNA_key, cache_dir=cache_dir), output_path=None)
+    return cached_stage('combined_df_long', build, [noNA_key], {}, cache_dir)
+
+
+def final_df_key(long_key, weather_path=None, price_filenames=None, cache_dir=CACHE_DIR):
+    weather_path = weather_path or WEATHER_PATH
+    price_filenames = price_filenames or PRICE_FILENAMES
+
+    def build():
+        weather_df = pd.read_csv(weather_path, delimiter=';', encoding='utf-8')
+        weather_df['DateTime'] = pd.to_datetime(weather_df['DateTime'])
+        price_df = KEprocessing.consolidate_data(price_filenames, 'price')
+        power_df = read_stage('combined_df_long', long_key, cache_dir=cache_dir)
+        return KEprocessing.merge_weather_price(power_df, weather_df, price_df, output_path=None)
+
+    return cached_stage('final_df', build, [long_key, weather_path] + list(price_filenames), {}, cache_dir)
+
+
+def load_combined_df_noNA(filenames=None, residential_threshold=0.03, commercial_threshold=3, min_non_nan=3,
+                          columns=None, years=None, customer_types=None, cache_dir=CACHE_DIR):
+    key = combined_df_noNA_key(filenames, residential_threshold, commercial_threshold, min_non_nan, cache_dir)
+    return read_stage('combined_df_noNA', key, columns, years, customer_types, cache_dir)
+
+
+def load_combined_df_long(filenames=None, residential_threshold=0.03, commercial_threshold=3, min_non_nan=3,
+                          columns=None, years=None, customer_types=None, cache_dir=CACHE_DIR):
+    noNA_key = combined_df_noNA_key(filenames, residential_threshold, commercial_threshold, min_non_nan, cache_dir)
+    key = combined_df_long_key(noNA_key, cache_dir)
+    return read_stage('combined_df_long', key, columns, years, customer_types, cache_dir)
+
+
+def load_final_df(filenames=None, residential_threshold=0.03, commercial_threshold=3, min_non_nan=3,
+                  weather_path=None, price_filenames=None, columns=None, years=None, customer_types=None, cache_dir=CACHE_DIR):
+    noNA_key = combined_df_noNA_key(filenames, residential_threshold, commercial_threshold, min_non_nan, cache_dir)
+    long_key = combined_df_long_key(noNA_key, cache_dir)
+    key = final_df_key(long_key, weather_path, price_filenames, cache_dir)
+    return read_stage('final_df', key, columns, years, customer_types, cache_dir)
@@ -0,0 +1,275 @@
+import functools
+import logging
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from utils import KEcache, KEfeatures, KEpipeline, KEprocessing, KEschema
+
+# Materialized rollup of the cleaned meter data for the overview figures and the yearly commercial and
+# residential frames, so they no longer filter and resample the full long data every time.
+#
+#   day.parquet           one row per (DATE, YEAR, AREA, ISPRIVATEPERSON) with the summed HOUR_0..HOUR_23,
+#                         their total Power_Consumption and the number of customers
+#   membership.parquet    which customers appear per (YEAR, MONTH, AREA, ISPRIVATEPERSON), for distinct
+#                         customer counts per month and year
+#   features_hour.parquet the hourly weather and price features
+#   features_day.parquet  their daily sums and non-null counts, for customer-weighted means
+#
+# Hourly, daily, monthly and yearly slices are rolled up from these tables at query time, which takes
+# milliseconds since the day table has a few rows per day. update_cube only adds the days after the
+# last day in the cube, like the KEpipeline watermarks. ISPRIVATEPERSON is stored as 'Ja'/'Nej'
+# ('None' where missing) whether the input was compact or not.
+CUBE_DIR = 'data/cube'
+DIMENSIONS = ['YEAR', 'AREA', 'ISPRIVATEPERSON']
+HOUR_COLUMNS = KEschema.HOUR_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+
+def _path(name, cube_dir):
+    return os.path.join(cube_dir, f'{name}.parquet')
+
+
+@functools.lru_cache(maxsize=32)
+def _read_table(path, modified):
+    # Tables are cached in memory until their file changes
+    return pd.read_parquet(path)
+
+
+def _load(name, cube_dir=CUBE_DIR):
+    path = _path(name, cube_dir)
+    if not os.path.exists(path):
+        return None
+    return _read_table(path, os.path.getmtime(path))
+
+
+def _save(df, name, cube_dir):
+    path = _path(name, cube_dir)
+    df.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def cube_watermark(cube_dir=CUBE_DIR):
+    # Last day in the cube, e.g. for KEpipeline.load_stage_output('clean', start=cube_watermark())
+    end = KEpipeline.load_state(cube_dir).get('end')
+    return None if end is None else pd.Timestamp(end)
+
+
+def _dimension_frame(clean_df):
+    dates = pd.to_datetime(clean_df['DATE']).dt.normalize()
+    labels = pd.Series(KEschema.customer_type_labels(clean_df['ISPRIVATEPERSON']), index=clean_df.index)
+    return pd.DataFrame({
+        'DATE': dates,
+        'YEAR': dates.dt.year.astype(np.int16),
+        'AREA': clean_df['AREA'].astype(object).where(clean_df['AREA'].notna(), 'None').astype(str),
+        'ISPRIVATEPERSON': labels.where(labels.notna(), 'None').astype(str),
+    }, index=clean_df.index)
+
+
+def _day_cells(clean_df):
+    keys = _dimension_frame(clean_df)
+    hours = pd.DataFrame(clean_df[HOUR_COLUMNS].to_numpy(dtype=np.float64), columns=HOUR_COLUMNS, index=clean_df.index)
+    grouped = pd.concat([keys, hours], axis=1).groupby(['DATE'] + DIMENSIONS, sort=True)
+
+    cells = grouped[HOUR_COLUMNS].sum()
+    cells.insert(0, 'Power_Consumption', cells[HOUR_COLUMNS].sum(axis=1))
+    cells.insert(0, 'customers', clean_df['CUSTOMER'].groupby([keys[column] for column in ['DATE'] + DIMENSIONS]).nunique())
+    return cells.reset_index()
+
+
+def _membership(clean_df):
+    keys = _dimension_frame(clean_df)
+    keys['MONTH'] = keys['DATE'].dt.month.astype(np.int8)
+    keys['CUSTOMER'] = clean_df['CUSTOMER'].to_numpy()
+    return keys.drop(columns='DATE').drop_duplicates()
+
+
+def _feature_table(weather_df, price_df):
+    # One row per hour with the numeric weather and price columns
+    frames = []
+    for df in [weather_df, price_df]:
+        if df is not None:
+            df = df.assign(DateTime=pd.to_datetime(df['DateTime']))
+            numeric = [column for column in df.select_dtypes('number').columns if not column.startswith('Unnamed')]
+            frames.append(df[['DateTime'] + numeric].drop_duplicates('DateTime', keep='last').set_index('DateTime'))
+    return pd.concat(frames, axis=1).sort_index()
+
+
+def _feature_days(features_hour):
+    grouped = features_hour.groupby(features_hour.index.normalize().rename('DATE'))
+    sums = grouped.sum().add_suffix('__sum')
+    counts = grouped.count().add_suffix('__count')
+    return pd.concat([sums, counts], axis=1).reset_index()
+
+
+def update_cube(clean_df=None, weather_df=None, price_df=None, cube_dir=CUBE_DIR):
+    # clean_df is cleaned daily meter data (prepare_final_df or the KEpipeline 'clean' stage), weather_df
+    # the wide hourly weather table and price_df the consolidated prices. Meter days up to the cube's
+    # watermark are skipped, features replace the stored values for the same hours.
+    # Returns the number of new day cells and feature hours
+    os.makedirs(cube_dir, exist_ok=True)
+    state = KEpipeline.load_state(cube_dir)
+    added = {'day_cells': 0, 'feature_hours': 0}
+
+    if clean_df is not None and len(clean_df):
+        watermark = cube_watermark(cube_dir)
+        if watermark is not None:
+            clean_df = clean_df[pd.to_datetime(clean_df['DATE']) > watermark]
+        if len(clean_df):
+            cells = _day_cells(clean_df)
+            day = _load('day', cube_dir)
+            _save(cells if day is None else pd.concat([day, cells], ignore_index=True), 'day', cube_dir)
+
+            membership = _load('membership', cube_dir)
+            new_members = _membership(clean_df)
+            if membership is not None:
+                new_members = pd.concat([membership, new_members], ignore_index=True).drop_duplicates()
+            _save(new_members, 'membership', cube_dir)
+
+            state['end'] = str(cells['DATE'].max())
+            added['day_cells'] = len(cells)
+
+    if weather_df is not None or price_df is not None:
+        new_hours = _feature_table(weather_df, price_df)
+        features_hour = _load('features_hour', cube_dir)
+        if features_hour is not None:
+            features_hour = features_hour.set_index('DateTime')
+            new_hours = new_hours.combine_first(features_hour).sort_index()
+        _save(new_hours.rename_axis('DateTime').reset_index(), 'features_hour', cube_dir)
+        _save(_feature_days(new_hours), 'features_day', cube_dir)
+        added['feature_hours'] = len(new_hours) - (0 if features_hour is None else len(features_hour))
+
+    KEpipeline.save_state(state, cube_dir)
+    return added
+
+
+def build_cube(clean_df, weather_df=None, price_df=None, cube_dir=CUBE_DIR):
+    # Build the cube from scratch
+    shutil.rmtree(cube_dir, ignore_errors=True)
+    return update_cube(clean_df, weather_df, price_df, cube_dir)
+
+
+def build_from_sources(cube_dir=CUBE_DIR):
+    # Build the cube from the default inputs: the cached combined_df_noNA, the merged weather CSV and the
+    # yearly price files
+    weather_df = pd.read_csv(KEcache.WEATHER_PATH, delimiter=';', encoding='utf-8')
+    price_df = KEprocessing.consolidate_data(KEcache.PRICE_FILENAMES, 'price')
+    return build_cube(KEcache.load_combined_df_noNA(), weather_df, price_df, cube_dir)
+
+
+def _filtered_days(areas=None, customer_types=None, years=None, start=None, end=None, cube_dir=CUBE_DIR):
+    day = _load('day', cube_dir)
+    if day is None:
+        raise FileNotFoundError(f'No cube in {cube_dir}, run build_cube or build_from_sources first')
+
+    keep = np.ones(len(day), dtype=bool)
+    if areas is not None:
+        keep &= day['AREA'].isin(areas).to_numpy()
+    if customer_types is not None:
+        keep &= day['ISPRIVATEPERSON'].isin(KEschema.customer_type_labels(pd.Series(customer_types))).to_numpy()
+    if years is not None:
+        keep &= day['YEAR'].isin(years).to_numpy()
+    if start is not None:
+        keep &= (day['DATE'] >= pd.Timestamp(start).normalize()).to_numpy()
+    if end is not None:
+        keep &= (day['DATE'] <= pd.Timestamp(end)).to_numpy()
+    return day[keep]
+
+
+def _period_start(dates, grain):
+    if grain == 'D':
+        return dates
+    if grain == 'M':
+        return dates.dt.to_period('M').dt.start_time
+    if grain == 'Y':
+        return dates.dt.to_period('Y').dt.start_time
+    raise ValueError(f"grain must be one of 'H', 'D', 'M', 'Y', got {grain!r}")
+
+
+def query_cube(grain='D', by=('AREA', 'ISPRIVATEPERSON'), areas=None, customer_types=None, years=None, start=None,
+               end=None, features=None, cube_dir=CUBE_DIR):
+    # Power_Consumption summed per time step of `grain` ('H', 'D', 'M' or 'Y') and the dimensions in `by`,
+    # for the selected areas, customer types ('Ja'/'Nej') and years. features are averaged over the
+    # customer rows like a mean over the long data would, i.e. weighted by the customers of each day.
+    # customers is the number of distinct customers per step (per day for 'H')
+    by = list(by)
+    day = _filtered_days(areas, customer_types, years, start, end, cube_dir)
+    features = [] if features is None else list(features)
+
+    if grain == 'H':
+        hours = np.arange(24) * np.timedelta64(1, 'h')
+        long = pd.DataFrame({
+            'DateTime': (day['DATE'].to_numpy()[:, None] + hours[None, :]).ravel(),
+            'Power_Consumption': day[HOUR_COLUMNS].to_numpy().ravel(),
+            'customers': np.repeat(day['customers'].to_numpy(), 24),
+            **{column: np.repeat(day[column].to_numpy(), 24) for column in by},
+        })
+        result = long.groupby(['DateTime'] + by, sort=True)[['Power_Consumption', 'customers']].sum().reset_index()
+        if features:
+            features_hour = _load('features_hour', cube_dir).set_index('DateTime')
+            result = result.join(features_hour[features], on='DateTime')
+        return result
+
+    time = _period_start(day['DATE'], grain).rename('DateTime')
+    result = day.groupby([time] + [day[column] for column in by], sort=True)['Power_Consumption'].sum().to_frame()
+    result['customers'] = customer_counts(grain, by, areas, customer_types, years, start, end, cube_dir)
+
+    if features:
+        # Weighted by the customers of each day: sum(c_d * s_d) / sum(c_d * k_d) with s_d and k_d the
+        # day's feature sum and count of non-null hours
+        features_day = _load('features_day', cube_dir).set_index('DATE')
+        weights = day['customers'].to_numpy(dtype=np.float64)[:, None]
+        sums = features_day.reindex(day['DATE'])[[f'{feature}__sum' for feature in features]].to_numpy() * weights
+        counts = features_day.reindex(day['DATE'])[[f'{feature}__count' for feature in features]].to_numpy() * weights
+        keys = [time] + [day[column] for column in by]
+        weighted_sums = pd.DataFrame(sums, columns=features, index=day.index).groupby(keys, sort=True).sum()
+        weighted_counts = pd.DataFrame(counts, columns=features, index=day.index).groupby(keys, sort=True).sum()
+        result = result.join(weighted_sums / weighted_counts.replace(0, np.nan))
+
+    return result.reset_index()
+
+
+def customer_counts(grain='Y', by=('ISPRIVATEPERSON',), areas=None, customer_types=None, years=None, start=None,
+                    end=None, cube_dir=CUBE_DIR):
+    # Distinct customers per time step and dimensions, grain 'D', 'M', 'Y' or None for the whole period.
+    # Monthly and yearly counts come from the membership table and are filtered to whole months
+    by = list(by)
+    if grain == 'D':
+        day = _filtered_days(areas, customer_types, years, start, end, cube_dir)
+        return day.groupby([day['DATE'].rename('DateTime')] + [day[column] for column in by], sort=True)['customers'].sum()
+
+    membership = _load('membership', cube_dir)
+    keep = np.ones(len(membership), dtype=bool)
+    if areas is not None:
+        keep &= membership['AREA'].isin(areas).to_numpy()
+    if customer_types is not None:
+        keep &= membership['ISPRIVATEPERSON'].isin(KEschema.customer_type_labels(pd.Series(customer_types))).to_numpy()
+    if years is not None:
+        keep &= membership['YEAR'].isin(years).to_numpy()
+    month_start = pd.to_datetime(pd.DataFrame({'year': membership['YEAR'], 'month': membership['MONTH'], 'day': 1}))
+    if start is not None:
+        keep &= (month_start >= pd.Timestamp(start).to_period('M').start_time).to_numpy()
+    if end is not None:
+        keep &= (month_start <= pd.Timestamp(end)).to_numpy()
+    membership, month_start = membership[keep], month_start[keep]
+
+    if grain is None:
+        keys = [membership[column] for column in by]
+        return membership.groupby(keys, sort=True)['CUSTOMER'].nunique() if keys else membership['CUSTOMER'].nunique()
+    time = _period_start(month_start, grain).rename('DateTime')
+    return membership.groupby([time] + [membership[column] for column in by], sort=True)['CUSTOMER'].nunique()
+
+
+def yearly_frame(customer_type, year, grain='H', features=None, cube_dir=CUBE_DIR):
+    # The yearly commercial ('Nej') or residential ('Ja') frame the modelling notebooks start from, one
+    # row per hour with Power_Consumption summed over the customers and the features. Resampled to 'D'
+    # with sum and mean it gives the same daily frame as the full yearly CSV did. The cube is built from
+    # the default sources (build_from_sources) the first time, e.g. on a fresh checkout
+    features = KEfeatures.EXOGENOUS if features is None else features
+    if _load('day', cube_dir) is None:
+        logger.info('No cube in %s yet, building it from the sources', cube_dir)
+        build_from_sources(cube_dir)
+    frame = query_cube(grain, by=(), customer_types=[customer_type], years=[year], features=features, cube_dir=cube_dir)
+    return frame[['DateTime', KEfeatures.TARGET] + list(features)]
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Lag matrices and lookback windows for the forecasting models. Windows are strided views over one
+# contiguous array, nothing is copied until a model asks for a batch
+
+# Target and exogenous features used throughout the modelling notebooks
+TARGET = 'Power_Consumption'
+EXOGENOUS = ['Price', 'Dew Point Temperature_P39']
+
+
+def daily_model_frame(df, features=None):
+    # The daily frame every modelling notebook starts from: power summed and the exogenous features
+    # averaged per day, with missing prices set to 0
+    features = EXOGENOUS if features is None else features
+    if 'DateTime' in df.columns:
+        df = df.set_index(pd.to_datetime(df['DateTime']))
+    daily = df[[TARGET] + features].resample('D').agg({TARGET: 'sum', **{feature: 'mean' for feature in features}})
+    if 'Price' in daily.columns:
+        daily['Price'] = daily['Price'].fillna(0)
+    return daily
+
+
+def window_view(values, look_back):
+    # values has shape (..., time, features). Returns a read-only view of shape
+    # (..., time - look_back + 1, look_back, features) where window i covers time steps i .. i + look_back - 1
+    values = np.ascontiguousarray(values)
+    windows = sliding_window_view(values, look_back, axis=-2)
+    return np.swapaxes(windows, -1, -2)
+
+
+def create_dataset(df, target, feature_cols, look_back=1):
+    # Vectorized version of the CNN notebook's create_dataset: X[i] holds feature_cols for rows
+    # i .. i + look_back - 1 and y[i] the target at row i + look_back. X is a view, copy it with
+    # np.array(X) if the model needs to write to it
+    values = df[feature_cols].to_numpy(dtype=np.float64)
+    X = window_view(values, look_back)[:-1]
+    y = df[target].to_numpy()[look_back:]
+    return X, y
+
+
+def lag_matrix(series, max_lag):
+    # Lagged copies of a 1-D series as a view of shape (len(series) - max_lag, max_lag), column j
+    # holding lag j + 1, together with the target values they predict
+    values = np.ascontiguousarray(np.asarray(series, dtype=np.float64))
+    lags = sliding_window_view(values, max_lag + 1)[:, ::-1]
+    return lags[:, 1:], lags[:, 0]
+
+
+def lag_features(df, target=TARGET, max_lag=7, exogenous=None):
+    # Tabular features for XGBoost and RandomForest: target lags 1..max_lag plus the exogenous
+    # columns of the same day, indexed like df minus the first max_lag rows
+    exogenous = EXOGENOUS if exogenous is None else exogenous
+    lags, y = lag_matrix(df[target], max_lag)
+    X = pd.DataFrame(lags, index=df.index[max_lag:], columns=[f'{target}_lag_{lag}' for lag in range(1, max_lag + 1)])
+    for column in exogenous:
+        X[column] = df[column].to_numpy()[max_lag:]
+    return X, pd.Series(y, index=df.index[max_lag:], name=target)
+
+
+def series_array(df, group_column, value_columns, time_column='DateTime'):
+    # Put many series (one per AREA, customer, ...) on a common time axis as one contiguous array of
+    # shape (groups, times, features). Missing steps are NaN, duplicate (group, time) rows keep the last
+    groups, group_codes = np.unique(df[group_column].to_numpy(), return_inverse=True)
+    times, time_codes = np.unique(df[time_column].to_numpy(), return_inverse=True)
+
+    values = np.full((len(groups), len(times), len(value_columns)), np.nan)
+    values[group_codes, time_codes] = df[value_columns].to_numpy(dtype=np.float64)
+
+    return values, groups, pd.DatetimeIndex(times) if np.issubdtype(times.dtype, np.datetime64) else times
+
+
+def iter_window_batches(values, look_back, target_index=0, batch_size=1024, dropna=True):
+    # Yield (X, y, group) batches of lookback windows over a (groups, times, features) array.
+    # Only a batch is ever copied, so hourly per-customer datasets never exist in memory in full.
+    # Windows or targets containing NaN are skipped when dropna is set
+    if values.ndim == 2:
+        values = values[None]
+    windows = window_view(values, look_back)
+    samples_per_group = values.shape[1] - look_back
+    total = values.shape[0] * max(samples_per_group, 0)
+
+    for start in range(0, total, batch_size):
+        ids = np.arange(start, min(start + batch_size, total))
+        group, sample = ids // samples_per_group, ids % samples_per_group
+        X = windows[group, sample]
+        y = values[group, sample + look_back, target_index]
+
+        if dropna:
+            keep = ~(np.isnan(X).any(axis=(1, 2)) | np.isnan(y))
+            X, y, group = X[keep], y[keep], group[keep]
+        if len(y):
+            yield X, y, group
@@ -0,0 +1,401 @@
+import argparse
+import collections
+import http.client
+import http.server
+import json
+import logging
+import os
+import pickle
+import socket
+import socketserver
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from utils import KEfeatures, KEtraining
+
+# Local forecast service. Fitted models and their latest feature window stay in an LRU cache bounded by
+# size, so a request only pays for prediction. Two kinds of models are served:
+#
+#   global models    one lag regressor over many series (fit_global_model). A batch of series is
+#                    forecast together, one predict call per step for all requested series
+#   group models     the per-group models of KEtraining.train_groups (sarimax, xgboost, random_forest,
+#                    prophet), one call per group covering the whole horizon
+#
+# Requests are JSON posted to /forecast over HTTP or a Unix socket:
+#
+#   {"model": "global:areas", "groups": ["Kalmar", "Smedby"], "horizon": 60}
+#   {"model": "sarimax", "groups": [["Kalmar", "Nej"]], "horizon": 30, "exog": {...}}
+#
+# Future exogenous values (Price, dew point) can be given as "exog": {"Price": [...], ...} for all groups
+# or as a list of such dicts in the order of "groups", otherwise (and after the end of a shorter list)
+# the mean of the group's last 7 days is carried forward. GET /stats reports the latency percentiles
+# of the served requests and the cache state.
+MODEL_DIR = 'data/models'
+CACHE_BYTES = 512 * 1024 ** 2
+EXOG_DAYS = 7
+
+logger = logging.getLogger(__name__)
+
+
+# Global lag models
+
+def fit_global_model(long_df, group_by, name, model='random_forest', max_lag=14, exogenous=None, params=None,
+                     output_dir=MODEL_DIR):
+    # One regressor over the target lags 1..max_lag and the same-day exogenous features of every group.
+    # Each series is divided by its mean so groups of different size share the model. The model and the
+    # last max_lag days of every group are saved to output_dir/global/<name>.pkl
+    exogenous = KEfeatures.EXOGENOUS if exogenous is None else exogenous
+    params = params or {}
+
+    groups, scales, targets, exog_tails, last_dates, X_parts, y_parts = [], [], [], [], [], [], []
+    for group, daily in KEtraining.group_daily_frames(long_df, group_by, exogenous):
+        daily = daily.fillna({column: 0 for column in exogenous})
+        if len(daily) <= max_lag:
+            continue
+        scale = daily[KEfeatures.TARGET].mean() or 1.0
+        scaled = daily.assign(**{KEfeatures.TARGET: daily[KEfeatures.TARGET] / scale})
+        X, y = KEfeatures.lag_features(scaled, KEfeatures.TARGET, max_lag, exogenous)
+        X_parts.append(X.to_numpy(dtype=np.float64))
+        y_parts.append(y.to_numpy(dtype=np.float64))
+
+        groups.append(group)
+        scales.append(scale)
+        targets.append(scaled[KEfeatures.TARGET].to_numpy()[-max_lag:])
+        exog_tails.append(daily[exogenous].to_numpy(dtype=np.float64)[-EXOG_DAYS:])
+        last_dates.append(daily.index[-1])
+
+    if model == 'xgboost':
+        import xgboost as xgb
+        regressor = xgb.XGBRegressor(**params.get('model_params', {'n_estimators': 500, 'max_depth': 3}))
+    else:
+        from sklearn.ensemble import RandomForestRegressor
+        regressor = RandomForestRegressor(**params.get('model_params', {'n_estimators': 200, 'max_depth': 8,
+                                                                        'min_samples_leaf': 2, 'n_jobs': -1}))
+    regressor.fit(np.concatenate(X_parts), np.concatenate(y_parts))
+
+    # Predicting with all cores per request only adds thread start-up to the latency
+    if hasattr(regressor, 'n_jobs'):
+        regressor.set_params(n_jobs=1)
+
+    entry = {'regressor': regressor, 'max_lag': max_lag, 'exogenous': exogenous, 'groups': groups,
+             'scales': np.array(scales), 'targets': np.array(targets), 'exog_tails': np.array(exog_tails),
+             'last_dates': pd.DatetimeIndex(last_dates)}
+    path = os.path.join(output_dir, 'global', f'{name}.pkl')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        pickle.dump(entry, file)
+    return path
+
+
+def forecast_global(entry, rows, horizon, future_exog=None):
+    # Recursive forecast of the series at positions rows of a global model entry. future_exog has shape
+    # (len(rows), horizon, n_exogenous). Every step is a single predict call for all series
+    window = entry['targets'][rows].copy()
+    if future_exog is None:
+        future_exog = np.repeat(entry['exog_tails'][rows].mean(axis=1)[:, None, :], horizon, axis=1)
+
+    predictions = np.empty((len(rows), horizon))
+    for step in range(horizon):
+        # lag_1 is the most recent value, like KEfeatures.lag_features
+        X = np.concatenate([window[:, ::-1], future_exog[:, step]], axis=1)
+        predictions[:, step] = entry['regressor'].predict(X)
+        window = np.concatenate([window[:, 1:], predictions[:, step:step + 1]], axis=1)
+
+    return predictions * entry['scales'][rows][:, None]
+
+
+# Per-group models from KEtraining
+
+def _load_group_entry(model, group, model_dir):
+    path = os.path.join(model_dir, model, KEtraining.group_file_name(group))
+    with open(path + '.pkl', 'rb') as file:
+        fitted = pickle.load(file)
+    window = pd.read_parquet(path + '.window.parquet')
+
+    if model == 'sarimax':
+        # Move the model state from the end of the training data to the last known day
+        exog_names = fitted.model.exog_names
+        fitted = fitted.append(window[KEfeatures.TARGET], exog=window[exog_names] if exog_names else None)
+    return {'model': fitted, 'window': window, 'last_date': window.index[-1]}, os.path.getsize(path + '.pkl')
+
+
+def _future_exog_frame(window, columns, dates, given=None):
+    # Exogenous values for the forecast days, given ones first, else the last EXOG_DAYS mean carried forward
+    given = given or {}
+    recent = window[columns].tail(EXOG_DAYS).mean() if columns else pd.Series(dtype=float)
+    future = pd.DataFrame({column: np.full(len(dates), recent[column]) for column in columns}, index=dates)
+    for column in columns:
+        if column in given:
+            values = np.asarray(given[column], dtype=np.float64)[:len(dates)]
+            future.iloc[:len(values), future.columns.get_loc(column)] = values
+    return future
+
+
+def forecast_group(model, entry, horizon, exog=None):
+    dates = pd.date_range(entry['last_date'] + pd.Timedelta('1D'), periods=horizon, freq='D')
+    fitted, window = entry['model'], entry['window']
+
+    if model == 'sarimax':
+        columns = fitted.model.exog_names or []
+        future = _future_exog_frame(window, columns, dates, exog)
+        predictions = fitted.forecast(horizon, exog=future if columns else None)
+    elif model in ('xgboost', 'random_forest'):
+        columns = list(getattr(fitted, 'feature_names_in_', KEfeatures.EXOGENOUS))
+        predictions = fitted.predict(_future_exog_frame(window, columns, dates, exog).fillna(0))
+    elif model == 'prophet':
+        columns = list(fitted.extra_regressors)
+        future = _future_exog_frame(window, columns, dates, exog).rename_axis('ds').reset_index()
+        predictions = fitted.predict(future)['yhat']
+    else:
+        raise ValueError(f'Model {model!r} cannot be served')
+    return dates, np.asarray(predictions, dtype=np.float64)
+
+
+# Cache and service
+
+class ModelCache:
+    # LRU cache bounded by the total size of its entries in bytes. load(key) returns (entry, size)
+    def __init__(self, load, max_bytes=CACHE_BYTES):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+        entry, size = self.load(key)
+        with self.lock:
+            self.misses += 1
+            if key not in self.entries:
+                self.entries[key] = (entry, size)
+                self.total_bytes += size
+            # The newest entry always stays, even if it is larger than the whole cache
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+        return entry
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def _group_key(group):
+    # JSON lists stand for the tuple keys of multi-column groups, one-element keys count as the value itself
+    if isinstance(group, (list, tuple)):
+        return group[0] if len(group) == 1 else tuple(group)
+    return group
+
+
+def _exog_values(values):
+    # {column: 1-D float array} of one group's future exogenous values, as given in the request
+    if not isinstance(values, dict):
+        raise ValueError('exog must map column names to lists of values')
+    arrays = {}
+    for column, series in values.items():
+        arrays[column] = np.asarray(series, dtype=np.float64)
+        if arrays[column].ndim != 1:
+            raise ValueError(f'exog {column!r} must be a list of values, got {arrays[column].ndim} dimensions')
+    return arrays
+
+
+def _group_exog(exog, n_groups):
+    # One dict of future exogenous values per requested group
+    if isinstance(exog, list):
+        if len(exog) != n_groups:
+            raise ValueError(f'{len(exog)} exog entries for {n_groups} groups')
+        return [_exog_values(values or {}) for values in exog]
+    return [_exog_values(exog or {})] * n_groups
+
+
+class ForecastService:
+    def __init__(self, model_dir=MODEL_DIR, cache_bytes=CACHE_BYTES, latency_window=10_000):
+        self.model_dir = model_dir
+        self.cache = ModelCache(self._load, cache_bytes)
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.lock = threading.Lock()
+
+    def _load(self, key):
+        kind, model, group = key
+        if kind == 'global':
+            path = os.path.join(self.model_dir, 'global', f'{model}.pkl')
+            with open(path, 'rb') as file:
+                entry = pickle.load(file)
+            entry['positions'] = {_group_key(group): position for position, group in enumerate(entry['groups'])}
+            return entry, os.path.getsize(path)
+        return _load_group_entry(model, group, self.model_dir)
+
+    def forecast(self, request):
+        # Answer one request dict, see the module comment. Returns the response dict
+        started = time.perf_counter()
+        model, horizon = request['model'], int(request.get('horizon', 60))
+        if not isinstance(model, str):
+            raise TypeError(f'model must be a string, got {type(model).__name__}')
+        # Model names come from the client and end up in file paths, only plain names are accepted
+        name = model.split(':', 1)[1] if model.startswith('global:') else model
+        if name in ('', '.', '..') or os.path.basename(name) != name or (os.altsep and os.altsep in name):
+            raise ValueError(f'invalid model name {model!r}')
+        if horizon < 1:
+            raise ValueError(f'horizon must be positive, got {horizon}')
+        groups = [_group_key(group) for group in request['groups']]
+        exogs = dict(zip(groups, _group_exog(request.get('exog'), len(groups))))
+        forecasts, errors = [], {}
+
+        if model.startswith('global:'):
+            entry = self.cache.get(('global', model.split(':', 1)[1], None))
+            found = [group for group in groups if group in entry['positions']]
+            errors.update({str(group): 'unknown group' for group in groups if group not in entry['positions']})
+            rows = np.array([entry['positions'][group] for group in found], dtype=np.intp)
+
+            # Given values where present, the carried forward mean elsewhere
+            future_exog = np.repeat(entry['exog_tails'][rows].mean(axis=1)[:, None, :], horizon, axis=1)
+            for position, group in enumerate(found):
+                for column_index, column in enumerate(entry['exogenous']):
+                    if column in exogs[group]:
+                        values = exogs[group][column][:horizon]
+                        future_exog[position, :len(values), column_index] = values
+
+            predictions = forecast_global(entry, rows, horizon, future_exog) if len(rows) else None
+            for position, group in enumerate(found):
+                dates = pd.date_range(entry['last_dates'][rows[position]] + pd.Timedelta('1D'), periods=horizon, freq='D')
+                forecasts.append({'group': group, 'dates': dates.strftime('%Y-%m-%d').tolist(),
+                                  'values': predictions[position].tolist()})
+        else:
+            for group in groups:
+                try:
+                    entry = self.cache.get(('group', model, group))
+                    dates, values = forecast_group(model, entry, horizon, exogs[group])
+                    forecasts.append({'group': group, 'dates': dates.strftime('%Y-%m-%d').tolist(),
+                                      'values': values.tolist()})
+                except OSError as error:
+                    # The message names the model file, keep it in the server log
+                    logger.warning('No model for %s %s: %s', model, group, error)
+                    errors[str(group)] = 'no fitted model for this group'
+                except (TypeError, ValueError) as error:
+                    logger.warning('Forecast of %s %s failed: %s: %s', model, group, type(error).__name__, error)
+                    errors[str(group)] = 'forecast failed, check the exog values'
+
+        latency = time.perf_counter() - started
+        with self.lock:
+            self.latencies.append(latency)
+        return {'forecasts': forecasts, 'errors': errors, 'latency_ms': round(latency * 1000, 3)}
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+        summary = {'requests': len(latencies), 'cache': self.cache.stats()}
+        if len(latencies):
+            summary.update({f'p{q}_ms': round(float(np.percentile(latencies, q)), 3) for q in (50, 95, 99)})
+            summary['max_ms'] = round(float(latencies.max()), 3)
+        return summary
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    service = None
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.service.stats())
+        elif self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/forecast':
+            self._reply(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self._reply(200, self.service.forecast(request))
+        except OSError as error:
+            # Details stay in the server log, they contain the model paths
+            logger.warning('Forecast request failed: %s: %s', type(error).__name__, error)
+            self._reply(404, {'error': 'unknown model'})
+        except (KeyError, TypeError, ValueError) as error:
+            logger.warning('Invalid forecast request: %s: %s', type(error).__name__, error)
+            self._reply(400, {'error': 'invalid request, expected model, groups, and optionally horizon and exog'})
+        except Exception:
+            # Anything else is a bug, the client still gets an answer instead of a closed connection
+            logger.exception('Forecast request failed')
+            self._reply(500, {'error': 'internal error'})
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address, log through logging instead of stderr
+        logger.debug(format, *args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host='127.0.0.1', port=8765, socket_path=None):
+    # HTTP server for the service on host:port, or on a Unix socket when socket_path is given
+    handler = type('Handler', (_Handler,), {'service': service})
+    if socket_path is None:
+        return http.server.ThreadingHTTPServer((host, port), handler)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    return _UnixHTTPServer(socket_path, handler)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_forecast(request, host='127.0.0.1', port=8765, socket_path=None, path='/forecast'):
+    # Small client for the service, POSTs request (or GETs when request is None) and returns the JSON reply
+    connection = _UnixHTTPConnection(socket_path) if socket_path else http.client.HTTPConnection(host, port, timeout=60)
+    try:
+        if request is None:
+            connection.request('GET', path)
+        else:
+            connection.request('POST', path, json.dumps(request), {'Content-Type': 'application/json'})
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve forecasts of the fitted models over HTTP or a Unix socket.')
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', default=None, help='Listen on this Unix socket instead of host:port')
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BYTES // 1024 ** 2)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    server = make_server(ForecastService(args.model_dir, args.cache_mb * 1024 ** 2), args.host, args.port, args.socket)
+    logger.info('Serving forecasts from %s on %s', args.model_dir, args.socket or f'{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,258 @@
+import cProfile
+import contextlib
+import json
+import logging
+import os
+import resource
+import time
+import tracemalloc
+import uuid
+import pandas as pd
+
+# Per-stage instrumentation for the pipeline. Every stage run through a StageRecorder appends one JSON
+# line to the log with wall and CPU time, peak RSS, rows in and out and bytes read and written, e.g.
+#
+#   recorder = StageRecorder()
+#   combined_df = recorder.call('consolidate_power', KEprocessing.consolidate_data, filenames, 'power')
+#
+# The default measurements only read counters the kernel keeps anyway, so it can stay on in nightly
+# runs. tracemalloc (trace_memory=True) and cProfile (profile_dir=...) are opt in, both slow the
+# stage down noticeably.
+LOG_PATH = 'data/logs/pipeline.jsonl'
+
+logger = logging.getLogger(__name__)
+
+
+def set_verbosity(level):
+    # 0 only warnings, 1 progress messages, 2 also previews of the intermediate frames (the head()
+    # printouts of reshape_power_df and merge_weather_price)
+    logging.basicConfig(format='%(message)s')
+    for name in ['utils', '__main__']:
+        logging.getLogger(name).setLevel({0: logging.WARNING, 1: logging.INFO}.get(level, logging.DEBUG))
+
+
+def _reset_peak_rss():
+    # Linux lets a process reset its high water mark, so the peak can be taken per stage.
+    # Elsewhere the peak stays the process lifetime maximum
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / 1024 if os.uname().sysname == 'Darwin' else maxrss / 1024
+
+
+def _io_counters():
+    # Bytes this process read and wrote through system calls, None where /proc is not available
+    try:
+        with open('/proc/self/io', 'r') as file:
+            counters = dict(line.split(': ') for line in file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _file_paths(values):
+    # Existing files named by the arguments of a stage, also inside lists like the yearly filenames
+    paths = []
+    for value in values:
+        if isinstance(value, (str, os.PathLike)) and os.path.isfile(value):
+            paths.append(value)
+        elif isinstance(value, (list, tuple)):
+            paths.extend(_file_paths(value))
+    return paths
+
+
+def _row_count(values):
+    rows = [len(value) for value in values if isinstance(value, (pd.DataFrame, pd.Series))]
+    return sum(rows) if rows else None
+
+
+class StageRecorder:
+    def __init__(self, log_path=LOG_PATH, profile_dir=None, trace_memory=False, run_id=None):
+        self.log_path = log_path
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None, inputs=None, outputs=None):
+        # Measures the body of the with block. The yielded record can be updated inside it, e.g.
+        # record['rows_out'] = len(df). inputs and outputs are file paths used for the byte counts
+        record = {'run_id': self.run_id, 'stage': name, 'started_at': pd.Timestamp.now().isoformat(), 'rows_in': rows_in,
+                  'rows_out': None, 'bytes_read': None, 'bytes_written': None}
+        inputs, outputs = list(inputs or []), list(outputs or [])
+
+        rss_reset = _reset_peak_rss()
+        io_before = _io_counters()
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if self.trace_memory:
+            tracemalloc.start()
+        profiler = cProfile.Profile() if self.profile_dir else None
+        if profiler:
+            profiler.enable()
+        wall_started, cpu_started = time.perf_counter(), time.process_time()
+
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException as error:
+            record['status'] = 'failed'
+            record['error'] = f'{type(error).__name__}: {error}'
+            raise
+        finally:
+            record['wall_seconds'] = round(time.perf_counter() - wall_started, 4)
+            record['cpu_seconds'] = round(time.process_time() - cpu_started, 4)
+            io_after = _io_counters()
+            # Worker processes (the process pools) are counted once they have been joined
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record['child_cpu_seconds'] = round(children.ru_utime + children.ru_stime
+                                                - children_before.ru_utime - children_before.ru_stime, 4)
+            if profiler:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                record['profile'] = os.path.join(self.profile_dir, f'{self.run_id}_{name}.prof')
+                profiler.dump_stats(record['profile'])
+            if self.trace_memory:
+                record['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+                tracemalloc.stop()
+            record['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+            record['peak_rss_scope'] = 'stage' if rss_reset else 'process'
+
+            # Sizes of the named files, falling back to the process I/O counters when none were given
+            if inputs:
+                record['bytes_read'] = sum(os.path.getsize(path) for path in inputs if os.path.isfile(path))
+            elif io_before and io_after:
+                record['bytes_read'] = io_after[0] - io_before[0]
+            if outputs:
+                record['bytes_written'] = sum(os.path.getsize(path) for path in outputs if os.path.isfile(path))
+            elif io_before and io_after:
+                record['bytes_written'] = io_after[1] - io_before[1]
+
+            self._write(record)
+
+    def call(self, name, function, *args, **kwargs):
+        # Run function(*args, **kwargs) as a stage. Rows in are the rows of the DataFrame arguments, rows
+        # out those of the result (the first element for functions returning a tuple), input files are
+        # the file paths among the arguments and the output file is the output_path argument
+        output_path = kwargs.get('output_path')
+        with self.stage(name, _row_count(list(args) + list(kwargs.values())),
+                        _file_paths(list(args) + list(kwargs.values())),
+                        [output_path] if output_path else None) as record:
+            result = function(*args, **kwargs)
+            record['rows_out'] = _row_count([result[0] if isinstance(result, tuple) else result])
+        return result
+
+    def _write(self, record):
+        self.records.append(record)
+        logger.info('%s: %s in %.2fs, peak RSS %.0f MB, rows %s -> %s', record['stage'], record['status'],
+                    record['wall_seconds'], record['peak_rss_mb'], record['rows_in'], record['rows_out'])
+        if self.log_path:
+            os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+            with open(self.log_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(record, default=str) + '\n')
+
+    def summary(self):
+        return pd.DataFrame(self.records)
+
+
+def load_log(log_path=LOG_PATH, run_id=None):
+    log = pd.read_json(log_path, lines=True)
+    return log if run_id is None else log[log['run_id'] == run_id]
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    # The weather scripts read and write Weather_P{p}_full.csv in the working directory
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def refresh_weather_table(recorder, weather_path='final_combined_weather_data.csv', parameters=None, years=None,
+                          weather_dir='.'):
+    # Download, tidy and merge the SMHI parameters as three stages and write the merged table to
+    # weather_path (relative to the current directory, not weather_dir). Returns the merged table
+    from utils import get_weather_parameters, merge_weather_parameters
+
+    parameters = parameters or get_weather_parameters.parameters
+    years = years or get_weather_parameters.years
+    full_paths = [os.path.join(weather_dir, f'Weather_P{parameter}_full.csv') for parameter in parameters]
+
+    with recorder.stage('fetch_weather', outputs=full_paths) as record, working_directory(weather_dir):
+        for parameter in parameters:
+            get_weather_parameters.fetch_and_save_csv(parameter)
+        record['rows_out'] = len(parameters)
+    with recorder.stage('tidy_weather', inputs=full_paths) as record, working_directory(weather_dir):
+        yearly_frames = get_weather_parameters.process_all_parameters(parameters, years)
+        record['rows_out'] = sum(len(frame) for frames in yearly_frames.values() for frame in frames.values())
+    with recorder.stage('merge_weather', outputs=[weather_path]) as record:
+        weather_df, _ = merge_weather_parameters.merge_weather_parameters(parameters, years, yearly_frames)
+        weather_df.to_csv(weather_path, index=False, sep=';', encoding='utf-8')
+        record['rows_out'] = len(weather_df)
+    return weather_df
+
+
+def run_pipeline(power_filenames, price_filenames, weather_path='final_combined_weather_data.csv',
+                 residential_threshold=0.03, commercial_threshold=3, min_non_nan=3, output_path='data/final_df.csv',
+                 recorder=None, refresh_weather=False, weather_parameters=None, weather_years=None, weather_dir='.',
+                 fetch_prices=None):
+    # prepare_final_df, reshape_power_df and merge_weather_price as separate stages, with the price
+    # consolidation and the weather table load recorded next to them. Returns (final_df, recorder)
+    #
+    # refresh_weather downloads the SMHI parameter files into weather_dir, tidies them and merges them
+    # into weather_path first (get_weather_parameters and merge_weather_parameters, one stage each).
+    # fetch_prices is a dict of fetch_electricity_prices.fetch_prices_for_years arguments, e.g.
+    # {'regions': ['SE4'], 'years': [2023], 'output_path': 'data/electricity_prices.csv'}, fetched as
+    # a stage before the price files are consolidated
+    from utils import KEprocessing
+
+    recorder = recorder or StageRecorder()
+    if fetch_prices:
+        from utils import fetch_electricity_prices
+
+        with recorder.stage('fetch_prices', outputs=[fetch_prices['output_path']]) as record:
+            record['rows_out'], failures = fetch_electricity_prices.fetch_prices_for_years(**fetch_prices)
+            record['failed_days'] = len(failures)
+
+    weather_df = None
+    if refresh_weather:
+        weather_df = refresh_weather_table(recorder, weather_path, weather_parameters, weather_years, weather_dir)
+
+    combined_df = recorder.call('consolidate_power', KEprocessing.consolidate_data, power_filenames, 'power')
+    with recorder.stage('daily_totals', rows_in=len(combined_df)) as record:
+        combined_df['One_Day_Power'] = combined_df[KEprocessing.HOUR_COLUMNS].sum(axis=1)
+        combined_df['One_Day_Power_NaN'] = combined_df[KEprocessing.HOUR_COLUMNS].isna().sum(axis=1)
+        record['rows_out'] = len(combined_df)
+    combined_df = recorder.call('replace_invalid_with_row_mean', KEprocessing.replace_invalid_with_row_mean,
+                                combined_df, residential_threshold, commercial_threshold, min_non_nan)
+    long_df = recorder.call('reshape_power_df', KEprocessing.reshape_power_df, combined_df, output_path=None)
+    del combined_df
+
+    price_df = recorder.call('consolidate_price', KEprocessing.consolidate_data, price_filenames, 'price')
+    if weather_df is None:
+        with recorder.stage('load_weather', inputs=[weather_path]) as record:
+            weather_df = pd.read_csv(weather_path, delimiter=';', encoding='utf-8')
+            weather_df['DateTime'] = pd.to_datetime(weather_df['DateTime'])
+            record['rows_out'] = len(weather_df)
+
+    final_df = recorder.call('merge_weather_price', KEprocessing.merge_weather_price, long_df, weather_df, price_df,
+                             output_path=output_path)
+    return final_df, recorder
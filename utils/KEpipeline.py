@@ -0,0 +1,163 @@
+import json
+import os
+import pandas as pd
+
+from utils import KEprocessing
+
+# Incremental runner over the KEprocessing stages. Every stage appends its output for the newly
+# processed range as a parquet part under data/incremental/<stage>/ and records the range in
+# state.json, so a refresh only cleans, reshapes and merges what arrived since the last run.
+#
+#   clean    daily meter rows after replace_invalid_with_row_mean, watermark on 'DATE'
+#   long     reshape_power_df of the new clean rows, watermark on 'DATE'
+#   final    merge_weather_price of the new long rows, watermark on 'DateTime'. Hours are only
+#            merged once weather and price both reach them, later hours wait for the next run
+#   daily    per day and customer type rollup of final. Only the days touched by newly merged
+#            rows are recomputed and replaced
+STATE_DIR = 'data/incremental'
+TIME_COLUMNS = {'clean': 'DATE', 'long': 'DateTime', 'final': 'DateTime'}
+
+
+def load_state(state_dir):
+    # state.json of an incremental store (this runner, KEcube), {} before the first run
+    state_path = os.path.join(state_dir, 'state.json')
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_state(state, state_dir):
+    state_path = os.path.join(state_dir, 'state.json')
+    with open(state_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def _watermark(state, stage):
+    end = state.get(stage, {}).get('end')
+    return None if end is None else pd.Timestamp(end)
+
+
+def _append_part(df, stage, time_column, state, state_dir):
+    # Write df as the next part of a stage and record its time range
+    stage_dir = os.path.join(state_dir, stage)
+    os.makedirs(stage_dir, exist_ok=True)
+    stage_state = state.setdefault(stage, {'parts': []})
+
+    file_name = f'part_{len(stage_state["parts"]):05d}.parquet'
+    df.to_parquet(os.path.join(stage_dir, file_name), index=False)
+
+    start, end = df[time_column].min(), df[time_column].max()
+    stage_state['parts'].append({'file': file_name, 'start': str(start), 'end': str(end), 'rows': len(df)})
+    if stage_state.get('end') is None or end > pd.Timestamp(stage_state['end']):
+        stage_state['end'] = str(end)
+
+
+def load_stage_output(stage, start=None, end=None, columns=None, state_dir=STATE_DIR):
+    # Rows of a stage with time column in (start, end], reading only the parts that overlap
+    if stage == 'daily':
+        path = os.path.join(state_dir, 'daily', 'daily.parquet')
+        return pd.read_parquet(path, columns=columns) if os.path.exists(path) else pd.DataFrame(columns=columns)
+
+    state = load_state(state_dir)
+    time_column = TIME_COLUMNS[stage]
+    parts = []
+    for part in state.get(stage, {}).get('parts', []):
+        if start is not None and pd.Timestamp(part['end']) <= start:
+            continue
+        if end is not None and pd.Timestamp(part['start']) > end:
+            continue
+        df = pd.read_parquet(os.path.join(state_dir, stage, part['file']), columns=columns)
+        if start is not None:
+            df = df[df[time_column] > start]
+        if end is not None:
+            df = df[df[time_column] <= end]
+        parts.append(df)
+
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(parts, ignore_index=True)
+
+
+def _daily_rollup(final_df):
+    # Power is summed, the weather and price features are averaged per day and customer type
+    final_df = final_df.dropna(subset=['ISPRIVATEPERSON'])
+    features = [column for column in final_df.select_dtypes('number').columns
+                if column not in ('CUSTOMER', 'Power_Consumption', 'One_Day_Power', 'One_Day_Power_NaN')]
+    aggregations = {'Power_Consumption': 'sum', **{column: 'mean' for column in features}}
+
+    daily = final_df.groupby([final_df['DateTime'].dt.floor('D').rename('day'), 'ISPRIVATEPERSON']).agg(aggregations)
+    return daily.reset_index()
+
+
+def run_incremental(power_df, weather_df, price_df, residential_threshold=0.03, commercial_threshold=3,
+                    min_non_nan=3, state_dir=STATE_DIR):
+    # power_df is the consolidated meter data (consolidate_data(..., 'power')), weather_df the wide
+    # weather table and price_df the consolidated prices. Only what is newer than each stage's
+    # watermark is processed. Returns the number of new rows per stage
+    os.makedirs(state_dir, exist_ok=True)
+    state = load_state(state_dir)
+    new_rows = {}
+
+    # Clean the days that have not been cleaned yet. Rows for days at or before the watermark
+    # are taken as already processed
+    power_df = power_df.assign(DATE=pd.to_datetime(power_df['DATE']))
+    watermark = _watermark(state, 'clean')
+    new_power = power_df if watermark is None else power_df[power_df['DATE'] > watermark]
+    if len(new_power):
+        new_power = new_power.copy()
+        new_power['One_Day_Power'] = new_power[KEprocessing.HOUR_COLUMNS].sum(axis=1)
+        new_power['One_Day_Power_NaN'] = new_power[KEprocessing.HOUR_COLUMNS].isna().sum(axis=1)
+        cleaned = KEprocessing.replace_invalid_with_row_mean(new_power, residential_threshold, commercial_threshold, min_non_nan)
+        if len(cleaned):
+            _append_part(cleaned.reset_index(drop=True), 'clean', 'DATE', state, state_dir)
+        new_rows['clean'] = len(cleaned)
+        save_state(state, state_dir)
+
+    # Reshape the cleaned days that have not been reshaped yet
+    pending = load_stage_output('clean', start=_watermark(state, 'long_source'), state_dir=state_dir)
+    if len(pending):
+        long_df = KEprocessing.reshape_power_df(pending, output_path=None)
+        _append_part(long_df, 'long', 'DateTime', state, state_dir)
+        state.setdefault('long_source', {})['end'] = str(pending['DATE'].max())
+        new_rows['long'] = len(long_df)
+        save_state(state, state_dir)
+
+    # Merge the long rows up to the last hour both weather and price reach
+    weather_df = weather_df.assign(DateTime=pd.to_datetime(weather_df['DateTime']))
+    price_df = price_df.assign(DateTime=pd.to_datetime(price_df['DateTime']))
+    limit = min(weather_df['DateTime'].max(), price_df['DateTime'].max())
+    watermark = _watermark(state, 'final')
+    pending = load_stage_output('long', start=watermark, end=limit, state_dir=state_dir)
+    if len(pending):
+        # Weather and price hours after the watermark (or from the first new hour on the first run)
+        # up to the last new hour, so the outer merge covers exactly the new range
+        end = pending['DateTime'].max()
+        if watermark is None:
+            in_window = lambda df: df[(df['DateTime'] >= pending['DateTime'].min()) & (df['DateTime'] <= end)]
+        else:
+            in_window = lambda df: df[(df['DateTime'] > watermark) & (df['DateTime'] <= end)]
+        final_df = KEprocessing.merge_weather_price(pending, in_window(weather_df), in_window(price_df), output_path=None)
+        _append_part(final_df, 'final', 'DateTime', state, state_dir)
+        new_rows['final'] = len(final_df)
+        save_state(state, state_dir)
+
+        # Recompute only the days the new rows fall on, reading those days back in full so a day
+        # split across two runs is rolled up over all of its hours
+        days = final_df['DateTime'].dt.floor('D')
+        affected = load_stage_output('final', start=days.min() - pd.Timedelta('1ns'), state_dir=state_dir)
+        affected = affected[affected['DateTime'].dt.floor('D').isin(days.unique())]
+        daily_update = _daily_rollup(affected)
+
+        daily_dir = os.path.join(state_dir, 'daily')
+        os.makedirs(daily_dir, exist_ok=True)
+        daily_path = os.path.join(daily_dir, 'daily.parquet')
+        if os.path.exists(daily_path):
+            daily = pd.read_parquet(daily_path)
+            daily = daily[~daily['day'].isin(daily_update['day'].unique())]
+            daily_update = pd.concat([daily, daily_update], ignore_index=True)
+        daily_update.sort_values(['day', 'ISPRIVATEPERSON']).reset_index(drop=True).to_parquet(daily_path, index=False)
+        new_rows['daily'] = int(daily_update['day'].isin(days.unique()).sum())
+
+    return new_rows
@@ -1,13 +1,51 @@
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
 
+from utils import KEschema
+
+# The 24 hourly reading columns of the meter export
+HOUR_COLUMNS = [f'HOUR_{i}' for i in range(24)]
+
+# Previews of the intermediate frames are logged at DEBUG level, see KEinstrument.set_verbosity
+logger = logging.getLogger(__name__)
+
 # Function to correct the 'Stensö' variations
 def correct_stenso(area_name):
     return 'Stensö' if area_name.startswith('Stens') else area_name
 
-def consolidate_data(filenames, dataset_type, fixed_encoding=True):
+def consolidate_data(filenames, dataset_type, fixed_encoding=True, parallel=False, chunksize=100_000, max_workers=None, output_path=None,
+                     compact=False, customer_dictionary_path=KEschema.CUSTOMER_DICTIONARY_PATH):
     assert dataset_type in ['power', 'price'], "dataset_type must be either 'power' or 'price'"
     
+    if parallel and dataset_type == 'power':
+        if output_path is not None:
+            if compact:
+                raise ValueError('compact=True needs the frame in memory, it cannot be combined with output_path')
+            return consolidate_power_parallel(filenames, fixed_encoding, chunksize, max_workers, output_path)
+        if not compact:
+            return consolidate_power_parallel(filenames, fixed_encoding, chunksize, max_workers)
+
+        # Each file's frame is compacted as it comes back, before the concat, so the parent mostly holds
+        # compact frames. Codes are assigned in filename order like the sequential path does
+        dictionary = KEschema.load_customer_dictionary(customer_dictionary_path)
+        dfs = []
+        for df in _iter_power_files_parallel(filenames, fixed_encoding, chunksize, max_workers):
+            df, dictionary = KEschema.compact_power_df(df, dictionary)
+            dfs.append(df)
+        combined_df = pd.concat(dfs, ignore_index=True)
+        del dfs
+        combined_df['AREA'] = combined_df['AREA'].astype(object).astype('category')
+        KEschema.validate_power_df(combined_df, 'daily', dictionary)
+        if customer_dictionary_path is not None:
+            KEschema.save_customer_dictionary(dictionary, customer_dictionary_path)
+        return combined_df
+
     encoding = 'ISO-8859-1' if fixed_encoding else None
     dfs = [pd.read_csv(filename, encoding=encoding) for filename in filenames]
     
@@ -23,7 +61,7 @@ def consolidate_data(filenames, dataset_type, fixed_encoding=True):
         combined_df['AREA'] = combined_df['AREA'].apply(correct_stenso)
         combined_df['DATE'] = pd.to_datetime(combined_df['DATE'])
         
-        return combined_df
+        return _compact_power(combined_df, customer_dictionary_path) if compact else combined_df
     
     elif dataset_type == 'price':
         # Specific steps for the price dataset
@@ -34,34 +72,199 @@ def consolidate_data(filenames, dataset_type, fixed_encoding=True):
         combined_prices_df_sorted = combined_prices_df.sort_values('DateTime')
         combined_prices_df_sorted = combined_prices_df_sorted.reset_index(drop=True)
         
-        return combined_prices_df_sorted
+        return KEschema.compact_features(combined_prices_df_sorted) if compact else combined_prices_df_sorted
+
+
+def _compact_power(df, customer_dictionary_path, kind='daily'):
+    # Compact dtypes (see KEschema) with the customer codes taken from, and new customers added to,
+    # the dictionary at customer_dictionary_path
+    dictionary = KEschema.load_customer_dictionary(customer_dictionary_path)
+    df, dictionary = KEschema.compact_power_df(df, dictionary)
+    KEschema.validate_power_df(df, kind, dictionary)
+    if customer_dictionary_path is not None:
+        KEschema.save_customer_dictionary(dictionary, customer_dictionary_path)
+    return df
+
+
+def _power_file_columns(filename, encoding):
+    # Header of a yearly power file after the 'VALUE_'/'ID_FROM_DATE' renames, plus 'YEAR'
+    header = pd.read_csv(filename, encoding=encoding, nrows=0).columns
+    header = header.str.replace('VALUE_', 'HOUR_')
+    return ['DATE' if column == 'ID_FROM_DATE' else column for column in header] + ['YEAR']
+
+
+def _fix_power_chunk(chunk, year, columns):
+    # Per-file fixes applied as each chunk is parsed
+    chunk.columns = chunk.columns.str.replace('VALUE_', 'HOUR_')
+    chunk = chunk.rename(columns={'ID_FROM_DATE': 'DATE'})
+    chunk['YEAR'] = year
+    chunk['AREA'] = chunk['AREA'].mask(chunk['AREA'].str.startswith('Stens', na=False), 'Stensö')
+    chunk['DATE'] = pd.to_datetime(chunk['DATE'])
+    return chunk.reindex(columns=columns)
+
+
+def _ingest_power_file(filename, columns, encoding, chunksize, part_path=None):
+    # Stream one yearly file in chunks. With a part_path the chunks are appended to it
+    # and only the row count is returned, otherwise the fixed frame is returned
+    year = filename[-8:-4]  # Extract year from filenames
+    chunks = []
+    n_rows = 0
+    for chunk in pd.read_csv(filename, encoding=encoding, chunksize=chunksize):
+        chunk = _fix_power_chunk(chunk, year, columns)
+        n_rows += len(chunk)
+        if part_path is None:
+            chunks.append(chunk)
+        else:
+            chunk.to_csv(part_path, mode='a', header=False, index=False)
+
+    if part_path is not None:
+        return n_rows
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _combined_power_columns(filenames, encoding):
+    # Same column order pd.concat would produce for the fixed yearly frames
+    columns = []
+    for filename in filenames:
+        columns += [column for column in _power_file_columns(filename, encoding) if column not in columns]
+    return columns
+
+
+def _iter_power_files_parallel(filenames, fixed_encoding=True, chunksize=100_000, max_workers=None):
+    # The fixed frame of every yearly file, parsed in a process pool and yielded in filename order
+    encoding = 'ISO-8859-1' if fixed_encoding else None
+    max_workers = max_workers or min(len(filenames), os.cpu_count() or 1)
+    columns = _combined_power_columns(filenames, encoding)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(_ingest_power_file, filenames, [columns] * len(filenames),
+                                [encoding] * len(filenames), [chunksize] * len(filenames))
 
 
-def replace_invalid_with_row_mean(df, residential_threshold, commercial_threshold, min_non_nan=3):
+def consolidate_power_parallel(filenames, fixed_encoding=True, chunksize=100_000, max_workers=None, output_path=None):
+    # Parse the yearly power files in a process pool, one file per worker, each streamed in chunks.
+    # Without output_path the combined DataFrame is returned. The parent then holds the frame of every
+    # file and the concatenated result at the same time, about twice the data. Only with output_path is
+    # memory bounded: every worker writes its chunks to a part file which is then appended to output_path
+    # in filename order, so no process ever holds more than one chunk, and output_path is returned
+    if output_path is None:
+        return pd.concat(list(_iter_power_files_parallel(filenames, fixed_encoding, chunksize, max_workers)),
+                         ignore_index=True)
+
+    encoding = 'ISO-8859-1' if fixed_encoding else None
+    max_workers = max_workers or min(len(filenames), os.cpu_count() or 1)
+    columns = _combined_power_columns(filenames, encoding)
+
+    parts_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        part_paths = [os.path.join(parts_dir, f'part_{i}.csv') for i in range(len(filenames))]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_ingest_power_file, filenames, [columns] * len(filenames),
+                              [encoding] * len(filenames), [chunksize] * len(filenames), part_paths))
+
+        with open(output_path, 'w', encoding='utf-8', newline='') as output:
+            pd.DataFrame(columns=columns).to_csv(output, index=False)
+            for part_path in part_paths:
+                if os.path.exists(part_path):
+                    with open(part_path, 'r', encoding='utf-8', newline='') as part:
+                        shutil.copyfileobj(part, output)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    return output_path
+
+
+def _hour_positions(df):
+    # Positions of HOUR_0..HOUR_23 in df. get_indexer gives -1 for a missing column, which iloc would
+    # read as the last column, so raise like df[HOUR_COLUMNS] does
+    hour_positions = df.columns.get_indexer(HOUR_COLUMNS)
+    if (hour_positions < 0).any():
+        missing = [column for column, position in zip(HOUR_COLUMNS, hour_positions) if position < 0]
+        raise KeyError(f'{missing} not in index')
+    return hour_positions
+
+
+def replace_invalid_with_row_mean(df, residential_threshold, commercial_threshold, min_non_nan=3, chunk_size=None):
     # Operate only on the hour columns
-    hour_columns = [f'HOUR_{i}' for i in range(24)]
-    
+    hour_columns = HOUR_COLUMNS
+    hour_positions = _hour_positions(df)
+
     # Filter out rows that don't meet the threshold for non-NaN values
-    df_filtered = df.dropna(thresh=min_non_nan, subset=hour_columns)
-    
+    keep = np.empty(len(df), dtype=bool)
+    for start, stop in _chunk_bounds(len(df), chunk_size):
+        block = df.iloc[start:stop, hour_positions].to_numpy(dtype=np.float64)
+        keep[start:stop] = (~np.isnan(block)).sum(axis=1) >= min_non_nan
+
     # Determine thresholds based on customer type
-    thresholds = df_filtered['ISPRIVATEPERSON'].map(lambda x: residential_threshold if x == 'Ja' else commercial_threshold)
-    
+    thresholds = np.where(KEschema.is_private(df['ISPRIVATEPERSON']), residential_threshold, commercial_threshold).astype(np.float64)
+
+    # Clean one block of input rows at a time straight into the preallocated output, so besides the input
+    # and the result only one chunk is held as float64. The blocks are row-major so the row sums round
+    # exactly like pandas' row mean does. The output is column-major, the layout pandas keeps columns in
+    values = np.empty((int(keep.sum()), len(hour_columns)), dtype=cleaned_hour_dtype(df.dtypes.iloc[hour_positions]),
+                      order='F')
+    written = 0
+    for start, stop in _chunk_bounds(len(df), chunk_size):
+        rows = keep[start:stop]
+        block = np.ascontiguousarray(df.iloc[start:stop, hour_positions].to_numpy(dtype=np.float64)[rows])
+        _clean_hour_block(block, thresholds[start:stop][rows])
+        values[written:written + len(block)] = block
+        written += len(block)
+
+    return _with_hour_values(df, np.flatnonzero(keep), values)
+
+
+def _with_hour_values(df, rows, values):
+    # The rows of df at positions rows with the hour columns replaced by values, without copying the hour
+    # columns of df. The other columns are taken around the hour columns to keep the column order
+    hour_positions = _hour_positions(df)
+    first, last = hour_positions.min(), hour_positions.max()
+    hours = pd.DataFrame(values, index=df.index[rows], columns=HOUR_COLUMNS, copy=False)
+    if last - first + 1 != len(HOUR_COLUMNS) or (np.diff(hour_positions) != 1).any():
+        # Hour columns spread over the frame, put them back in place
+        result = df.iloc[rows].copy()
+        result[HOUR_COLUMNS] = values
+        return result
+    before, after = df.iloc[rows, :first], df.iloc[rows, last + 1:]
+    return pd.concat([before, hours, after], axis=1)
+
+
+def cleaned_hour_dtype(dtypes):
+    # dtype of the cleaned hour values: float32 when every hour column already is (compact frames),
+    # float64 otherwise. Never an integer dtype, the row means and the NaN of all-invalid rows need a float
+    return np.result_type(np.float32, *dtypes)
+
+
+def _chunk_bounds(n_rows, chunk_size):
+    # Yield (start, stop) row ranges, a single range when no chunk size is given
+    step = n_rows if not chunk_size else chunk_size
+    for start in range(0, n_rows, max(step, 1)):
+        yield start, min(start + step, n_rows)
+
+
+def _clean_hour_block(values, thresholds):
     # Mask the values that are either above their respective thresholds or negative
-    df_filtered[hour_columns] = df_filtered[hour_columns].mask((df_filtered[hour_columns] < 0) | (df_filtered[hour_columns].gt(thresholds, axis=0)))
-    
+    values[(values < 0) | (values > thresholds[:, None])] = np.nan
+
     # Calculate the mean for each row excluding NaNs
-    row_means = df_filtered[hour_columns].mean(axis=1)
-    
+    missing = np.isnan(values)
+    counts = values.shape[1] - missing.sum(axis=1)
+    sums = np.where(missing, 0.0, values).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        row_means = sums / counts
+
     # Replace NaNs with the row's mean
-    df_filtered[hour_columns] = df_filtered[hour_columns].apply(lambda x: x.fillna(row_means[x.name]), axis=1)
-    
-    return df_filtered
+    rows, cols = np.nonzero(missing)
+    values[rows, cols] = row_means[rows]
 
 
-def prepare_final_df():
-    filenames = ['data/lnu_2020.csv', 'data/lnu_2021.csv', 'data/lnu_2022.csv', 'data/lnu_2023.csv']
-    combined_df = consolidate_data(filenames, 'power')
+def prepare_final_df(filenames=None, residential_threshold=0.03, commercial_threshold=3, min_non_nan_values=3,
+                     output_path='data/combined_df_noNA.csv', compact=False,
+                     customer_dictionary_path=KEschema.CUSTOMER_DICTIONARY_PATH):
+    if filenames is None:
+        filenames = ['data/lnu_2020.csv', 'data/lnu_2021.csv', 'data/lnu_2022.csv', 'data/lnu_2023.csv']
+    combined_df = consolidate_data(filenames, 'power', compact=compact, customer_dictionary_path=customer_dictionary_path)
 
     # Define the hourly columns
     hourly_columns = [f'HOUR_{i}' for i in range(24)]
@@ -70,69 +273,183 @@ def prepare_final_df():
     combined_df['One_Day_Power'] = combined_df[hourly_columns].sum(axis=1)
     # Calculate the sum of the hourly consumption being NaN and save to a new column
     combined_df['One_Day_Power_NaN'] = combined_df[hourly_columns].isna().sum(axis=1)
+    if compact:
+        combined_df['One_Day_Power_NaN'] = combined_df['One_Day_Power_NaN'].astype(np.int8)
     
-    # Define your thresholds
-    residential_threshold = 0.03  # 0.03 MWh for residential
-    commercial_threshold = 3      # 3 MWh for commercial
-
-    # Define the minimum number of non-NaN hourly values required to keep a row
-    min_non_nan_values = 3
-
+    # Thresholds default to 0.03 MWh for residential and 3 MWh for commercial, and rows need
+    # at least min_non_nan_values non-NaN hourly values to be kept
     combined_df_noNA = replace_invalid_with_row_mean(combined_df, residential_threshold, commercial_threshold, min_non_nan_values)
-    combined_df_noNA.to_csv('data/combined_df_noNA.csv')
+    if output_path is not None:
+        combined_df_noNA.to_csv(output_path)
     
     return(combined_df_noNA)
 
 
-def reshape_power_df(combined_df):
-    # Assuming combined_df is already loaded and has the columns 'DATE', 'HOUR_0', 'HOUR_1', ..., 'HOUR_23'
-    # Convert the DATE column to datetime data type
-    combined_df['DATE'] = pd.to_datetime(combined_df['DATE'])
+def _long_order(dates):
+    # For daily rows already sorted by date, return (row, hour) of every long row so that the
+    # long frame comes out sorted by DateTime. Rows sharing a date keep their relative order
+    # inside each hour, like a stable sort on DateTime would give
+    n = len(dates)
+    change = np.r_[True, dates[1:] != dates[:-1]] if n else np.zeros(0, dtype=bool)
+    starts = np.flatnonzero(change)
+    run = np.cumsum(change) - 1
+    sizes = np.diff(np.r_[starts, n])
+    within = np.arange(n) - starts[run]
+
+    # Long position of every (row, hour) pair: runs of equal dates keep their place and inside
+    # a run all rows of hour 0 come first, then hour 1, and so on
+    positions = (24 * starts[run] + within)[:, None] + np.arange(24)[None, :] * sizes[run][:, None]
+    order = np.empty(24 * n, dtype=np.intp)
+    order[positions.ravel()] = np.arange(24 * n)
 
-    # Melt the hourly columns into two new columns 'Time' and 'Power_Consumption'
-    combined_df_long = combined_df.melt(id_vars=['CUSTOMER', 'AREA', 'ISPRIVATEPERSON', 'DATE', 'YEAR', 'One_Day_Power', 'One_Day_Power_NaN'],
-                                        value_vars=[f'HOUR_{i}' for i in range(24)],
-                                        var_name='Time',
-                                        value_name='Power_Consumption')
+    return order // 24, order % 24
 
-    # Convert the 'Time' column to represent the actual time of day
-    combined_df_long['Time'] = combined_df_long['Time'].str.extract('(\d+)').astype(int)
-    combined_df_long['Time'] = pd.to_timedelta(combined_df_long['Time'], unit='h')
 
-    # Create 'DateTime' by adding 'Time' to 'DATE'
-    combined_df_long['DateTime'] = combined_df_long['DATE'] + combined_df_long['Time']
+def _long_frame(combined_df, dates, values, row_order, offset=0):
+    # Build the long rows for the daily rows at positions row_order (sorted by date)
+    block_dates = dates[row_order]
+    if (block_dates == block_dates.astype('datetime64[D]')).all():
+        rows, hours = _long_order(block_dates)
+    else:
+        # Dates with a time component can interleave across days, fall back to a stable sort
+        # over the hour-major order melt would produce
+        date_times = block_dates[None, :] + (np.arange(24) * np.timedelta64(1, 'h'))[:, None]
+        order = np.argsort(date_times.ravel(), kind='stable')
+        hours, rows = order // len(block_dates), order % len(block_dates)
+
+    source = row_order[rows]
+    combined_df_long = pd.DataFrame({'DateTime': block_dates[rows] + hours * np.timedelta64(1, 'h')},
+                                    index=pd.RangeIndex(offset, offset + len(rows)))
+    for column in ['CUSTOMER', 'AREA', 'ISPRIVATEPERSON']:
+        combined_df_long[column] = combined_df[column].array.take(source)
+    combined_df_long['Power_Consumption'] = values[source, hours]
+    for column in ['One_Day_Power', 'One_Day_Power_NaN']:
+        combined_df_long[column] = combined_df[column].array.take(source)
+
+    return combined_df_long
 
-    # Convert the DateTime column to datetime data type
-    combined_df_long['DateTime'] = pd.to_datetime(combined_df_long['DateTime'])
 
-    # Now you can drop the 'DATE' and 'Time' columns or other columns if they are no longer needed
-    combined_df_long = combined_df_long.drop(['DATE', 'Time','YEAR',], axis=1)
+def iter_power_long(combined_df, days_per_block=7):
+    # Lazily yield the long view of combined_df in DateTime order, one block of days at a time.
+    # Concatenating the blocks gives the frame reshape_power_df returns
+    dates = pd.to_datetime(combined_df['DATE']).to_numpy()
+    values = combined_df[HOUR_COLUMNS].to_numpy()
+    row_order = np.argsort(dates, kind='stable')
 
-    # Reorder columns to have 'DateTime' at the front if desired
-    combined_df_long = combined_df_long[['DateTime', 'CUSTOMER', 'AREA', 'ISPRIVATEPERSON', 'Power_Consumption','One_Day_Power','One_Day_Power_NaN']]
+    sorted_days = dates[row_order].astype('datetime64[D]')
+    day_starts = np.flatnonzero(np.r_[True, sorted_days[1:] != sorted_days[:-1]]) if len(dates) else np.zeros(0, dtype=np.intp)
+    block_starts = np.r_[day_starts[::days_per_block], len(dates)]
 
-    # Sort the DataFrame by the 'DateTime' column to ensure that the dates and times are in order
-    combined_df_long.sort_values(by='DateTime', inplace=True)
+    offset = 0
+    for start, stop in zip(block_starts[:-1], block_starts[1:]):
+        block = _long_frame(combined_df, dates, values, row_order[start:stop], offset)
+        offset += len(block)
+        yield block
+
+
+def reshape_power_df(combined_df, output_path='data/combined_df_long.csv'):
+    # Assuming combined_df is already loaded and has the columns 'DATE', 'HOUR_0', 'HOUR_1', ..., 'HOUR_23'
+    # Convert the DATE column to datetime data type
+    combined_df['DATE'] = pd.to_datetime(combined_df['DATE'])
 
-    # Reset the index of the DataFrame after sorting
-    combined_df_long.reset_index(drop=True, inplace=True)
+    # Spread the 24 hourly columns over 24 rows per day with index arithmetic on the fixed
+    # HOUR_0..HOUR_23 layout. Only the daily rows are sorted by date, the long frame comes out
+    # ordered by 'DateTime' without a sort of its own
+    dates = combined_df['DATE'].to_numpy()
+    row_order = np.argsort(dates, kind='stable')
+    combined_df_long = _long_frame(combined_df, dates, combined_df[HOUR_COLUMNS].to_numpy(), row_order)
 
     # Check the result
-    print(combined_df_long.head())
-    combined_df_long.to_csv('data/combined_df_long.csv', index=False)
+    logger.debug('Long power data:\n%s', combined_df_long.head())
+    if output_path is not None:
+        combined_df_long.to_csv(output_path, index=False)
     
     return combined_df_long
     
-def merge_weather_price(power_df, weather_df, price_df):
-    
+def build_hourly_dimension(weather_df, price_df, start=None, end=None):
+    # One row per hour from start to end (defaults to the span of weather and price data), with
+    # the weather and price columns side by side. The RangeIndex is the hour offset from the first
+    # hour, which is what the fact table stores as 'HOUR_KEY'
+    hourly = pd.merge(weather_df.drop_duplicates('DateTime'), price_df.drop_duplicates('DateTime'), on='DateTime', how='outer')
+    start = hourly['DateTime'].min() if start is None else min(start, hourly['DateTime'].min())
+    end = hourly['DateTime'].max() if end is None else max(end, hourly['DateTime'].max())
+
+    hours = pd.date_range(pd.Timestamp(start).floor('h'), pd.Timestamp(end).ceil('h'), freq='h')
+    dimension = hourly.set_index('DateTime').reindex(hours).rename_axis('DateTime').reset_index()
+
+    return dimension
+
+
+def hour_keys(date_times, dimension):
+    # Integer hour offsets of date_times into the dimension table, -1 where there is no such hour
+    origin = dimension['DateTime'].iloc[0]
+    offsets = pd.to_datetime(date_times).to_numpy() - np.datetime64(origin)
+    keys = offsets // np.timedelta64(1, 'h')
+    on_the_hour = offsets % np.timedelta64(1, 'h') == np.timedelta64(0, 'h')
+    valid = ~np.isnat(offsets) & on_the_hour & (keys >= 0) & (keys < len(dimension))
+
+    return np.where(valid, keys, -1).astype(np.int32)
+
+
+def attach_hourly_features(fact_df, dimension, columns=None):
+    # Look the weather and price features up by 'HOUR_KEY' with plain integer indexing
+    columns = list(dimension.columns) if columns is None else ['DateTime'] + [column for column in columns if column != 'DateTime']
+    features = dimension[columns].reindex(fact_df['HOUR_KEY'].to_numpy())
+    features.index = fact_df.index
+
+    return pd.concat([features, fact_df.drop(columns='HOUR_KEY')], axis=1)
+
+
+def iter_final_df(fact_df, dimension, batch_size=1_000_000, columns=None):
+    # Materialize the merged rows one batch at a time
+    for start in range(0, len(fact_df), batch_size):
+        yield attach_hourly_features(fact_df.iloc[start:start + batch_size], dimension, columns)
+
+
+# Default outputs of merge_weather_price. The star layout writes its fact table next to the dimension
+# table instead of over the merged final_df the notebooks read
+FINAL_DF_PATH = 'data/final_df.csv'
+FACT_DF_PATH = 'data/final_df_fact.csv'
+
+
+def merge_weather_price(power_df, weather_df, price_df, output_path=FINAL_DF_PATH, how='outer',
+                        dimension_path='data/final_df_hours.csv', compact=False):
+    if how not in ('outer', 'star'):
+        raise ValueError(f"how must be 'outer' or 'star', got {how!r}")
+
+    # With compact the weather and price features are stored as float32 like the readings
+    if compact:
+        weather_df, price_df = KEschema.compact_features(weather_df), KEschema.compact_features(price_df)
+
     # List of DataFrames to merge
     dataframes = [power_df, weather_df, price_df]
-    print(power_df.head())
-    print(weather_df.head())
-    print(price_df.head())
+    logger.debug('Power data:\n%s', power_df.head())
+    logger.debug('Weather data:\n%s', weather_df.head())
+    logger.debug('Price data:\n%s', price_df.head())
+
+    if how == 'star':
+        # Keep weather and price as one hourly dimension table and give the power rows only an
+        # integer key into it instead of copying every feature onto every customer row.
+        # Returns (fact_df, dimension), see attach_hourly_features and iter_final_df
+        dimension = build_hourly_dimension(weather_df, price_df, power_df['DateTime'].min(), power_df['DateTime'].max())
+        fact_df = power_df.drop(columns='DateTime')
+        fact_df.insert(0, 'HOUR_KEY', hour_keys(power_df['DateTime'], dimension))
+
+        if output_path == FINAL_DF_PATH:
+            output_path = FACT_DF_PATH
+        if output_path is not None:
+            fact_df.to_csv(output_path)
+        if dimension_path is not None:
+            dimension.to_csv(dimension_path, index_label='HOUR_KEY')
+
+        return fact_df, dimension
+
     # Merge all DataFrames on 'DateTime'
     final_combined_df = reduce(lambda left, right: pd.merge(left, right, on='DateTime', how='outer'), dataframes)
+    if compact:
+        final_combined_df = KEschema.restore_dtypes(final_combined_df, power_df)
         
-    final_combined_df.to_csv('data/final_df.csv')
+    if output_path is not None:
+        final_combined_df.to_csv(output_path)
     
-    return final_combined_df
\ No newline at end of file
+    return final_combined_df
@@ -0,0 +1,234 @@
+import os
+import pickle
+import shutil
+import numpy as np
+import pandas as pd
+
+from utils import KEschema
+
+# Load-profile analytics over the customer x day 24-hour profiles of the cleaned wide data (HOUR_0..HOUR_23).
+# The profiles are streamed in chunks, normalized, and used to fit an IncrementalPCA and a MiniBatchKMeans
+# per group (all data, calendar month as in figures/PCA_Month_*, or year and month) in a single pass, so
+# the full profile matrix never exists in memory. A second streaming pass writes the PCA projections and
+# cluster assignments to data/profiles/projections/ for plotting without refitting.
+#
+#   models = fit_profiles('data/combined_df_noNA.csv', group_by='month')
+#   project_profiles('data/combined_df_noNA.csv', models)
+#   projections = load_projections(groups=[1])
+PROFILE_DIR = 'data/profiles'
+HOUR_COLUMNS = KEschema.HOUR_COLUMNS
+KEY_COLUMNS = ['CUSTOMER', 'DATE', 'AREA', 'ISPRIVATEPERSON']
+
+
+def iter_profiles(source, chunk_size=100_000):
+    # Yield (keys, values) chunks of the wide daily data: keys holds KEY_COLUMNS and values the 24 hour
+    # readings as a float64 array. source is a DataFrame, a CSV (e.g. combined_df_noNA.csv) or a
+    # parquet file or list of parquet files (e.g. the KEcache combined_df_noNA partitions)
+    columns = KEY_COLUMNS + HOUR_COLUMNS
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, len(source), chunk_size):
+            chunk = source.iloc[start:start + chunk_size]
+            yield chunk[KEY_COLUMNS].reset_index(drop=True), chunk[HOUR_COLUMNS].to_numpy(dtype=np.float64)
+        return
+
+    paths = [source] if isinstance(source, (str, os.PathLike)) else list(source)
+    for path in paths:
+        if str(path).endswith('.csv'):
+            chunks = pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+        else:
+            import pyarrow.parquet as pq
+            batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns)
+            chunks = (batch.to_pandas() for batch in batches)
+        for chunk in chunks:
+            chunk['DATE'] = pd.to_datetime(chunk['DATE'])
+            yield chunk[KEY_COLUMNS], chunk[HOUR_COLUMNS].to_numpy(dtype=np.float64)
+
+
+def normalize_profiles(values, method='shape'):
+    # Normalize every row of a (days, 24) array at once. Returns (normalized, valid) where valid marks the
+    # rows that could be normalized (no NaN, and a positive total, peak or spread)
+    #   'shape'   share of the day's consumption per hour, rows sum to 1
+    #   'peak'    divided by the day's maximum
+    #   'zscore'  centred and scaled per day
+    #   None      the readings as they are
+    valid = ~np.isnan(values).any(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'shape':
+            scale = values.sum(axis=1, keepdims=True)
+            normalized = values / scale
+        elif method == 'peak':
+            scale = values.max(axis=1, keepdims=True)
+            normalized = values / scale
+        elif method == 'zscore':
+            scale = values.std(axis=1, keepdims=True)
+            normalized = (values - values.mean(axis=1, keepdims=True)) / scale
+        elif method is None:
+            return values, valid
+        else:
+            raise ValueError(f"method must be 'shape', 'peak', 'zscore' or None, got {method!r}")
+    valid &= scale[:, 0] > 0
+    return normalized, valid
+
+
+def profile_groups(keys, group_by=None):
+    # Group label of every profile: 'all', the calendar month (1-12) or 'YYYY-MM'
+    if group_by is None:
+        return np.full(len(keys), 'all', dtype=object)
+    dates = pd.to_datetime(keys['DATE'])
+    if group_by == 'month':
+        return dates.dt.month.to_numpy()
+    if group_by == 'year_month':
+        return dates.dt.strftime('%Y-%m').to_numpy()
+    raise ValueError(f"group_by must be None, 'month' or 'year_month', got {group_by!r}")
+
+
+class _GroupModel:
+    # IncrementalPCA and MiniBatchKMeans of one group, fitted from a buffer so every partial_fit gets at
+    # least batch_size rows
+    def __init__(self, n_components, n_clusters, batch_size, random_state):
+        from sklearn.cluster import MiniBatchKMeans
+        from sklearn.decomposition import IncrementalPCA
+
+        self.pca = IncrementalPCA(n_components=n_components)
+        self.kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, n_init=3)
+        self.batch_size = batch_size
+        self.buffer = []
+        self.buffered = 0
+        self.n_fitted = 0
+        self.n_skipped = 0
+
+    def add(self, values):
+        self.buffer.append(values)
+        self.buffered += len(values)
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        batch = np.concatenate(self.buffer)
+        self.buffer, self.buffered = [], 0
+        # The first partial_fit of either model needs at least n_components / n_clusters rows. A smaller
+        # final remainder is left out of the fit (it is still projected)
+        if len(batch) < max(self.pca.n_components, self.kmeans.n_clusters):
+            self.n_skipped += len(batch)
+            return
+        self.pca.partial_fit(batch)
+        self.kmeans.partial_fit(batch)
+        self.n_fitted += len(batch)
+
+    def finish(self):
+        self.flush()
+        self.buffer = []
+        return self
+
+
+def fit_profiles(source, group_by='month', method='shape', n_components=3, n_clusters=6, batch_size=20_000,
+                 chunk_size=100_000, random_state=0, output_dir=PROFILE_DIR):
+    # One pass over source fitting PCA and clustering per group. The clusters are fitted on the normalized
+    # 24-hour profiles, so their centres can be plotted as load shapes. The models are saved to
+    # output_dir/models.pkl and returned as {'group_by', 'method', 'models': {group: _GroupModel}}
+    models = {}
+    for keys, values in iter_profiles(source, chunk_size):
+        normalized, valid = normalize_profiles(values, method)
+        groups = profile_groups(keys, group_by)[valid]
+        normalized = normalized[valid]
+
+        # Split the chunk by group with one sort instead of one mask per group
+        order = np.argsort(groups, kind='stable')
+        unique, starts = np.unique(groups[order], return_index=True)
+        for group, rows in zip(unique, np.split(order, starts[1:])):
+            if group not in models:
+                models[group] = _GroupModel(n_components, n_clusters, batch_size, random_state)
+            models[group].add(normalized[rows])
+
+    fitted = {'group_by': group_by, 'method': method,
+              'models': {group: model.finish() for group, model in sorted(models.items())}}
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'models.pkl'), 'wb') as file:
+        pickle.dump(fitted, file)
+    profile_summary(fitted).to_csv(os.path.join(output_dir, 'summary.csv'), index=False)
+    return fitted
+
+
+def load_models(output_dir=PROFILE_DIR):
+    with open(os.path.join(output_dir, 'models.pkl'), 'rb') as file:
+        return pickle.load(file)
+
+
+def profile_summary(fitted):
+    # Explained variance and cluster sizes per group, and the cluster centres as 24-hour load shapes
+    rows = []
+    for group, model in fitted['models'].items():
+        if not model.n_fitted:
+            continue
+        row = {'group': group, 'profiles': model.n_fitted, 'skipped': model.n_skipped}
+        for component, ratio in enumerate(model.pca.explained_variance_ratio_, start=1):
+            row[f'PC{component}_explained_variance'] = ratio
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def cluster_centres(fitted):
+    # One row per (group, cluster) with the centre as HOUR_0..HOUR_23
+    frames = []
+    for group, model in fitted['models'].items():
+        if model.n_fitted:
+            centres = pd.DataFrame(model.kmeans.cluster_centers_, columns=HOUR_COLUMNS)
+            centres.insert(0, 'cluster', np.arange(len(centres)))
+            centres.insert(0, 'group', group)
+            frames.append(centres)
+    return pd.concat(frames, ignore_index=True)
+
+
+def project_profiles(source, fitted, chunk_size=100_000, output_dir=PROFILE_DIR):
+    # Second streaming pass: PC scores and cluster of every profile, written as one parquet part per
+    # chunk to output_dir/projections. Profiles that cannot be normalized or whose group has no fitted
+    # model get NaN scores and cluster -1. Returns the number of rows written
+    projections_dir = os.path.join(output_dir, 'projections')
+    shutil.rmtree(projections_dir, ignore_errors=True)
+    os.makedirs(projections_dir)
+    cluster_centres(fitted).to_csv(os.path.join(output_dir, 'cluster_centres.csv'), index=False)
+
+    n_components = max((model.pca.n_components for model in fitted['models'].values()), default=0)
+    n_rows = 0
+    for part, (keys, values) in enumerate(iter_profiles(source, chunk_size)):
+        normalized, valid = normalize_profiles(values, fitted['method'])
+        groups = profile_groups(keys, fitted['group_by'])
+        scores = np.full((len(keys), n_components), np.nan, dtype=np.float32)
+        clusters = np.full(len(keys), -1, dtype=np.int16)
+
+        for group, model in fitted['models'].items():
+            if not model.n_fitted:
+                continue
+            rows = np.flatnonzero(valid & (groups == group))
+            if len(rows):
+                scores[rows] = model.pca.transform(normalized[rows])
+                clusters[rows] = model.kmeans.predict(normalized[rows])
+
+        projections = keys.reset_index(drop=True).copy()
+        projections['group'] = groups.astype(str)
+        for component in range(n_components):
+            projections[f'PC{component + 1}'] = scores[:, component]
+        projections['cluster'] = clusters
+        projections.to_parquet(os.path.join(projections_dir, f'part_{part:05d}.parquet'), index=False)
+        n_rows += len(projections)
+
+    return n_rows
+
+
+def analyze_profiles(source, group_by='month', method='shape', n_components=3, n_clusters=6, output_dir=PROFILE_DIR,
+                     **kwargs):
+    # Fit and project in one call. Returns the fitted models
+    fitted = fit_profiles(source, group_by, method, n_components, n_clusters, output_dir=output_dir, **kwargs)
+    project_profiles(source, fitted, kwargs.get('chunk_size', 100_000), output_dir)
+    return fitted
+
+
+def load_projections(columns=None, groups=None, output_dir=PROFILE_DIR):
+    # The saved projections, optionally only some columns and groups (e.g. groups=[1] for January)
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(os.path.join(output_dir, 'projections'), format='parquet')
+    row_filter = None if groups is None else ds.field('group').isin([str(group) for group in groups])
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
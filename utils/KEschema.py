@@ -0,0 +1,200 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Compact typed representation of the meter data, from consolidate_data(..., compact=True) through
+# reshape_power_df to merge_weather_price:
+#
+#   CUSTOMER          int32 code, the original IDs are kept in the customer dictionary
+#   AREA              category
+#   ISPRIVATEPERSON   bool, True for 'Ja' (nullable 'boolean' if some rows have no type)
+#   YEAR              int16
+#   HOUR_0..HOUR_23, Power_Consumption, One_Day_Power and the weather and price features   float32
+#   One_Day_Power_NaN int8
+#
+# float32 keeps about 7 significant digits, far more than the meters report. A long row takes about
+# 23 bytes instead of well over 100 with the object columns. CSV and parquet outputs of compact
+# frames keep the codes, expand_power_df turns them back into customer IDs and 'Ja'/'Nej'.
+CUSTOMER_DICTIONARY_PATH = 'data/customer_ids.csv'
+HOUR_COLUMNS = [f'HOUR_{i}' for i in range(24)]
+
+COMPACT_DTYPES = {
+    'CUSTOMER': 'int32',
+    'AREA': 'category',
+    'ISPRIVATEPERSON': 'bool',
+    'YEAR': 'int16',
+    'DATE': 'datetime64[ns]',
+    'DateTime': 'datetime64[ns]',
+    'One_Day_Power': 'float32',
+    'One_Day_Power_NaN': 'int8',
+    'Power_Consumption': 'float32',
+    **{column: 'float32' for column in HOUR_COLUMNS},
+}
+KEY_COLUMNS = {'daily': ['CUSTOMER', 'DATE'], 'long': ['CUSTOMER', 'DateTime']}
+
+
+# Customer dictionary. Codes are positions in the dictionary, which is only ever appended to, so a
+# code keeps meaning the same customer across runs and files
+
+def load_customer_dictionary(path=CUSTOMER_DICTIONARY_PATH):
+    if path is None or not os.path.exists(path):
+        return pd.Index([], name='CUSTOMER')
+    return pd.Index(pd.read_csv(path, index_col='CUSTOMER_CODE')['CUSTOMER'], name='CUSTOMER')
+
+
+def save_customer_dictionary(dictionary, path=CUSTOMER_DICTIONARY_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    pd.DataFrame({'CUSTOMER': dictionary}).rename_axis('CUSTOMER_CODE').to_csv(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def encode_customers(customers, dictionary=None):
+    # Returns (int32 codes, dictionary extended with the customers it did not know yet)
+    dictionary = pd.Index([], name='CUSTOMER') if dictionary is None else dictionary
+    customers = pd.Series(customers).to_numpy()
+    if dictionary.dtype != object and customers.dtype == object:
+        dictionary = dictionary.astype(object)
+
+    new = pd.unique(customers[dictionary.get_indexer(customers) == -1])
+    if len(new):
+        dictionary = dictionary.append(pd.Index(new, name='CUSTOMER'))
+    if len(dictionary) > np.iinfo(np.int32).max:
+        raise ValueError(f'{len(dictionary)} customers do not fit int32 codes')
+    return dictionary.get_indexer(customers).astype(np.int32), dictionary
+
+
+def decode_customers(codes, dictionary):
+    return dictionary.take(np.asarray(codes)).to_numpy()
+
+
+# Customer type. Code comparing against 'Ja'/'Nej' goes through these so it works on both forms
+
+def is_private(customer_types):
+    # Boolean array, True for residential customers. Missing types count as commercial like a
+    # comparison with 'Ja' would
+    values = pd.Series(customer_types)
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return values.fillna(False).to_numpy(dtype=bool)
+    return (values == 'Ja').to_numpy()
+
+
+def customer_type_labels(customer_types):
+    # 'Ja'/'Nej' labels (None where missing) for either form
+    values = pd.Series(customer_types)
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return values.astype(object).map({True: 'Ja', False: 'Nej'}).where(values.notna(), None).to_numpy()
+    return values.astype(object).to_numpy()
+
+
+def _to_bool(customer_types):
+    if pd.api.types.is_bool_dtype(customer_types.dtype):
+        return customer_types
+    mapped = customer_types.map({'Ja': True, 'Nej': False})
+    return mapped.astype(bool) if mapped.notna().all() else mapped.astype('boolean')
+
+
+def compact_power_df(df, dictionary=None):
+    # Convert a consolidated daily, long or merged frame to the compact dtypes. CUSTOMER is replaced
+    # by its code unless it already is one (int32). Returns (compact frame, customer dictionary)
+    df = df.copy()
+    if 'CUSTOMER' in df.columns and df['CUSTOMER'].dtype != np.int32:
+        codes, dictionary = encode_customers(df['CUSTOMER'], dictionary)
+        df['CUSTOMER'] = codes
+    if 'AREA' in df.columns:
+        df['AREA'] = df['AREA'].astype('category')
+    if 'ISPRIVATEPERSON' in df.columns:
+        df['ISPRIVATEPERSON'] = _to_bool(df['ISPRIVATEPERSON'])
+    if 'YEAR' in df.columns:
+        df['YEAR'] = pd.to_numeric(df['YEAR']).astype(np.int16)
+    for column in ['DATE', 'DateTime']:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column])
+    if 'One_Day_Power_NaN' in df.columns and df['One_Day_Power_NaN'].notna().all():
+        df['One_Day_Power_NaN'] = df['One_Day_Power_NaN'].astype(np.int8)
+
+    return compact_features(df), dictionary
+
+
+def compact_features(df):
+    # float64 columns (readings, weather and price features) to float32
+    float_columns = df.select_dtypes('float64').columns
+    return df.astype({column: np.float32 for column in float_columns}) if len(float_columns) else df
+
+
+def restore_dtypes(df, reference):
+    # After an outer merge the integer and bool columns of the power frame come back as float and
+    # object because of the hours without power data. Cast them to the nullable equivalents
+    nullable = {np.dtype('int32'): 'Int32', np.dtype('int8'): 'Int8', np.dtype('bool'): 'boolean'}
+    casts = {column: nullable[dtype] for column, dtype in reference.dtypes.items()
+             if column in df.columns and dtype in nullable and df[column].dtype != dtype}
+    return df.astype(casts) if casts else df
+
+
+def expand_power_df(df, dictionary):
+    # Back to the original form: customer IDs, 'Ja'/'Nej' and object AREA, e.g. to write the CSVs
+    # the notebooks read
+    df = df.copy()
+    if 'CUSTOMER' in df.columns and df['CUSTOMER'].dtype == np.int32:
+        df['CUSTOMER'] = decode_customers(df['CUSTOMER'], dictionary)
+    if 'AREA' in df.columns:
+        df['AREA'] = df['AREA'].astype(object)
+    if 'ISPRIVATEPERSON' in df.columns:
+        df['ISPRIVATEPERSON'] = customer_type_labels(df['ISPRIVATEPERSON'])
+    return df
+
+
+def validate_power_df(df, kind='daily', dictionary=None):
+    # Check a compact frame and raise ValueError listing every problem found. kind is 'daily' for
+    # the consolidated and cleaned data, 'long' for reshape_power_df and merge_weather_price output
+    problems = []
+    keys = KEY_COLUMNS[kind]
+
+    missing = [column for column in keys + ['AREA', 'ISPRIVATEPERSON'] if column not in df.columns]
+    if missing:
+        problems.append(f'missing columns {missing}')
+    if kind == 'daily':
+        missing_hours = [column for column in HOUR_COLUMNS if column not in df.columns]
+        if missing_hours:
+            problems.append(f'missing hour columns {missing_hours}')
+
+    for column, dtype in COMPACT_DTYPES.items():
+        if column not in df.columns:
+            continue
+        actual = df[column].dtype
+        if column == 'ISPRIVATEPERSON':
+            valid = pd.api.types.is_bool_dtype(actual)
+        elif dtype == 'category':
+            valid = isinstance(actual, pd.CategoricalDtype)
+        elif dtype.startswith('datetime64'):
+            valid = pd.api.types.is_datetime64_dtype(actual)
+        else:
+            # The nullable Int32/Int8 of an outer merge count as their numpy dtype
+            valid = getattr(actual, 'numpy_dtype', actual) == np.dtype(dtype)
+        if not valid:
+            problems.append(f'{column} is {actual}, expected {dtype}')
+
+    # Only rows with power data are checked, an outer merge adds weather and price hours without one
+    power_rows = df.dropna(subset=['CUSTOMER']) if 'CUSTOMER' in df.columns else df
+    present_keys = [column for column in keys if column in df.columns]
+    null_keys = power_rows[present_keys].isna().sum()
+    for column, count in null_keys[null_keys > 0].items():
+        problems.append(f'{count} rows without {column}')
+    if len(present_keys) == len(keys):
+        duplicates = power_rows.duplicated(keys).sum()
+        if duplicates:
+            problems.append(f'{duplicates} duplicate {"/".join(keys)} rows')
+
+    if dictionary is not None and 'CUSTOMER' in df.columns and len(power_rows):
+        codes = power_rows['CUSTOMER'].to_numpy()
+        if codes.min() < 0 or codes.max() >= len(dictionary):
+            problems.append(f'CUSTOMER codes outside the dictionary of {len(dictionary)} customers')
+
+    readings = [column for column in HOUR_COLUMNS + ['Power_Consumption'] if column in df.columns]
+    if readings:
+        infinite = np.isinf(df[readings].to_numpy(dtype=np.float64)).sum()
+        if infinite:
+            problems.append(f'{infinite} infinite readings')
+
+    if problems:
+        raise ValueError('Invalid power data: ' + '; '.join(problems))
+    return df
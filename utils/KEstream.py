@@ -0,0 +1,235 @@
+import datetime
+import numpy as np
+import pandas as pd
+
+from utils import KEprocessing, KEschema
+
+# Streaming counterpart of KEprocessing.replace_invalid_with_row_mean. Hourly readings are pushed one at a
+# time as (CUSTOMER, AREA, ISPRIVATEPERSON, DateTime, Power_Consumption) records, e.g. the rows of the long
+# frame in DateTime order, and every reading is flagged on arrival:
+#
+#   ok                the reading is kept
+#   missing           NaN, or the hour never arrived
+#   negative          below zero
+#   above_threshold   above the residential or commercial threshold
+#   spike             far outside the customer's recent readings (only with spike_mads, off by default)
+#
+# Flagged readings are replaced by the mean of the valid readings of the same customer-day, so a day is
+# emitted once it is complete: when its HOUR_23 reading arrives or the customer's next day starts. Each
+# customer keeps one open day (24 slots) and running statistics of fixed size, whatever the length of the
+# stream. Without spike_mads the cleaned values are exactly those of the batch function, the days are
+# cleaned with the same code (see replace_invalid_streaming).
+#
+#   for record in clean_stream(iter_long_records(long_df)):
+#       ...
+FLAG_NAMES = ['ok', 'missing', 'negative', 'above_threshold', 'spike']
+OK, MISSING, NEGATIVE, ABOVE_THRESHOLD, SPIKE = range(len(FLAG_NAMES))
+RECORD_COLUMNS = ['CUSTOMER', 'AREA', 'ISPRIVATEPERSON', 'DateTime', 'Power_Consumption']
+
+# Step size of the running median and median absolute deviation, roughly the weight of the latest reading
+ROBUST_RATE = 0.05
+
+HOURS = [datetime.timedelta(hours=hour) for hour in range(24)]
+
+
+class _CustomerState:
+    # Everything kept per customer: the open day and the running statistics of the valid readings
+    __slots__ = ['area', 'customer_type', 'threshold', 'day', 'values', 'flags', 'present',
+                 'readings', 'valid', 'invalid', 'missing', 'spikes', 'days', 'dropped_days',
+                 'mean', 'm2', 'median', 'mad']
+
+    def __init__(self):
+        self.day = None
+        self.readings = self.valid = self.invalid = self.missing = self.spikes = 0
+        self.days = self.dropped_days = 0
+        self.mean = self.m2 = 0.0
+        self.median = self.mad = np.nan
+
+    def update(self, value):
+        # Welford's mean and variance, and stochastic approximations of the median and the median
+        # absolute deviation that follow the customer's recent level
+        self.valid += 1
+        delta = value - self.mean
+        self.mean += delta / self.valid
+        self.m2 += delta * (value - self.mean)
+        self.update_robust(value)
+
+    def update_robust(self, value):
+        if self.valid == 1 or np.isnan(self.median):
+            self.median, self.mad = value, 0.0
+            return
+        deviation = abs(value - self.median)
+        step = ROBUST_RATE * (self.mad or deviation)
+        self.median += step if value > self.median else -step if value < self.median else 0.0
+        self.mad += ROBUST_RATE * (deviation - self.mad)
+
+
+class StreamCleaner:
+    # push() returns the customer-days completed by the reading, flush() those still open at the end of
+    # the stream. A day is (CUSTOMER, AREA, ISPRIVATEPERSON, date, values, flags) with the 24 cleaned
+    # values and their flag codes. Days are cleaned batch_days at a time, 1 emits every day immediately
+    def __init__(self, residential_threshold=0.03, commercial_threshold=3, min_non_nan=3, batch_days=1,
+                 spike_mads=None, warmup_readings=24 * 14):
+        self.residential_threshold = residential_threshold
+        self.commercial_threshold = commercial_threshold
+        self.min_non_nan = min_non_nan
+        self.batch_days = batch_days
+        self.spike_mads = spike_mads
+        self.warmup_readings = warmup_readings
+        self.customers = {}
+        self.pending = []
+        # is_private per distinct customer type value, there are only a handful ('Ja', 'Nej', True, ...)
+        self._private = {}
+
+    def _threshold(self, customer_type):
+        if customer_type not in self._private:
+            self._private[customer_type] = bool(KEschema.is_private([customer_type])[0])
+        return self.residential_threshold if self._private[customer_type] else self.commercial_threshold
+
+    def push(self, customer, area, customer_type, date_time, value):
+        state = self.customers.get(customer)
+        if state is None:
+            state = self.customers[customer] = _CustomerState()
+        day = date_time.date()
+        if state.day != day:
+            if state.day is not None:
+                self._close_day(customer, state)
+            self._open_day(state, area, customer_type, day)
+
+        hour = date_time.hour
+        state.readings += 1
+        if value is None or value != value:
+            flag = MISSING
+        else:
+            state.present += 1
+            if value < 0:
+                flag = NEGATIVE
+            elif value > state.threshold:
+                flag = ABOVE_THRESHOLD
+            elif (self.spike_mads and state.valid >= self.warmup_readings and state.mad > 0
+                  and abs(value - state.median) > self.spike_mads * state.mad):
+                # Left out of the day mean but still moves the median, so a lasting change in
+                # level stops being flagged
+                flag = SPIKE
+                state.spikes += 1
+                state.update_robust(value)
+            else:
+                flag = OK
+                state.update(value)
+            if flag in (NEGATIVE, ABOVE_THRESHOLD):
+                state.invalid += 1
+        state.values[hour] = np.nan if flag == SPIKE else value
+        state.flags[hour] = flag
+
+        if hour == 23:
+            self._close_day(customer, state)
+        return self._drain() if len(self.pending) >= self.batch_days else []
+
+    def _open_day(self, state, area, customer_type, day):
+        state.area, state.customer_type, state.day = area, customer_type, day
+        state.threshold = self._threshold(customer_type)
+        state.values = [np.nan] * 24
+        state.flags = [MISSING] * 24
+        state.present = 0
+
+    def _close_day(self, customer, state):
+        # Days with fewer than min_non_nan readings are dropped, like the batch function drops the rows
+        state.days += 1
+        state.missing += state.flags.count(MISSING)
+        if state.present >= self.min_non_nan:
+            self.pending.append((customer, state.area, state.customer_type, state.day, state.values, state.flags,
+                                 state.threshold))
+        else:
+            state.dropped_days += 1
+        state.day = None
+
+    def _drain(self):
+        if not self.pending:
+            return []
+        pending, self.pending = self.pending, []
+        values = np.array([day[4] for day in pending], dtype=np.float64)
+        thresholds = np.array([day[6] for day in pending], dtype=np.float64)
+        KEprocessing._clean_hour_block(values, thresholds)
+        return [(customer, area, customer_type, day, values[row], np.array(flags, dtype=np.int8))
+                for row, (customer, area, customer_type, day, _, flags, _) in enumerate(pending)]
+
+    def flush(self):
+        for customer, state in self.customers.items():
+            if state.day is not None:
+                self._close_day(customer, state)
+        return self._drain()
+
+    def stats(self):
+        # One row per customer with the reading counts and the running statistics of the valid readings
+        rows = [{'CUSTOMER': customer, 'AREA': state.area, 'ISPRIVATEPERSON': state.customer_type,
+                 'readings': state.readings, 'valid': state.valid, 'invalid': state.invalid,
+                 'missing': state.missing, 'spikes': state.spikes, 'days': state.days,
+                 'dropped_days': state.dropped_days, 'mean': state.mean if state.valid else np.nan,
+                 'std': np.sqrt(state.m2 / (state.valid - 1)) if state.valid > 1 else np.nan,
+                 'median': state.median, 'mad': state.mad}
+                for customer, state in self.customers.items()]
+        return pd.DataFrame(rows)
+
+
+def iter_wide_records(source):
+    # Hourly records of the wide daily data (CUSTOMER, AREA, ISPRIVATEPERSON, DATE, HOUR_0..HOUR_23), row by
+    # row. source is a DataFrame or an iterable of them, e.g. pd.read_csv(path, chunksize=100_000)
+    for chunk in [source] if isinstance(source, pd.DataFrame) else source:
+        dates = pd.to_datetime(chunk['DATE']).dt.to_pydatetime()
+        values = chunk[KEprocessing.HOUR_COLUMNS].to_numpy(dtype=np.float64).tolist()
+        for customer, area, customer_type, date, day_values in zip(chunk['CUSTOMER'], chunk['AREA'],
+                                                                   chunk['ISPRIVATEPERSON'], dates, values):
+            for hour, value in enumerate(day_values):
+                yield customer, area, customer_type, date + HOURS[hour], value
+
+
+def iter_long_records(source):
+    # Hourly records of long frames like reshape_power_df's (or an iterable of them, e.g. iter_power_long)
+    for chunk in [source] if isinstance(source, pd.DataFrame) else source:
+        date_times = pd.to_datetime(chunk['DateTime']).dt.to_pydatetime()
+        yield from zip(chunk['CUSTOMER'], chunk['AREA'], chunk['ISPRIVATEPERSON'], date_times,
+                       chunk['Power_Consumption'].to_numpy(dtype=np.float64).tolist())
+
+
+def _hourly(days):
+    for customer, area, customer_type, day, values, flags in days:
+        start = datetime.datetime.combine(day, datetime.time())
+        for hour in range(24):
+            yield customer, area, customer_type, start + HOURS[hour], values[hour], FLAG_NAMES[flags[hour]]
+
+
+def clean_stream(records, cleaner=None, **kwargs):
+    # Cleaned hourly records (RECORD_COLUMNS plus FLAG) as the days complete. kwargs go to StreamCleaner,
+    # pass a cleaner to keep its statistics after the stream ends
+    cleaner = cleaner or StreamCleaner(**kwargs)
+    for record in records:
+        days = cleaner.push(*record)
+        if days:
+            yield from _hourly(days)
+    yield from _hourly(cleaner.flush())
+
+
+def records_frame(records):
+    # Collect cleaned hourly records into a long frame
+    df = pd.DataFrame.from_records(records, columns=RECORD_COLUMNS + ['FLAG'])
+    df['FLAG'] = pd.Categorical(df['FLAG'], categories=FLAG_NAMES)
+    return df
+
+
+def replace_invalid_streaming(df, residential_threshold, commercial_threshold, min_non_nan=3):
+    # Run the streaming cleaner over the wide frame df and return the same frame replace_invalid_with_row_mean
+    # would: the kept rows with their index and columns, hour values cleaned. df needs one row per
+    # customer-day, each row's HOUR_23 record completes its day so the days come back in row order
+    cleaner = StreamCleaner(residential_threshold, commercial_threshold, min_non_nan)
+    keep = np.zeros(len(df), dtype=bool)
+    cleaned = []
+    for position, record in enumerate(iter_wide_records(df)):
+        for day in cleaner.push(*record):
+            keep[position // 24] = True
+            cleaned.append(day[4])
+
+    df_filtered = df[keep].copy()
+    hour_columns = KEprocessing.HOUR_COLUMNS
+    values = np.array(cleaned, dtype=np.float64).reshape(-1, 24)
+    df_filtered[hour_columns] = values.astype(KEprocessing.cleaned_hour_dtype(df_filtered[hour_columns].dtypes), copy=False)
+    return df_filtered
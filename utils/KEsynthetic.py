@@ -0,0 +1,123 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Synthetic stand-ins for the files the pipeline reads, so it can be run and benchmarked outside our
+# environment. The meter files follow the lnu_YYYY.csv export: CUSTOMER, AREA (including the 'Stens...'
+# spelling variants), ISPRIVATEPERSON Ja/Nej, DATE and HOUR_0..HOUR_23, except the last year which uses
+# ID_FROM_DATE and VALUE_0..VALUE_23 like the 2023 export. Readings contain NaNs, negative values and
+# outliers above the cleaning thresholds
+
+AREAS = ['Kalmar', 'Ljungbyholm', 'Lindsdal', 'Smedby', 'Trekanten', 'Rinkabyholm', 'Påryd', 'Stensö',
+         'Stensö ', 'StensÖ', 'Stenso']
+
+# Column names of the SMHI files per parameter, see get_weather_parameters.column_names_mapping
+SMHI_PARAMETERS = {4: 'Vindhastighet', 6: 'Relativ Luftfuktighet', 7: 'Nederbördsmängd', 26: 'Lufttemperatur',
+                   27: 'Lufttemperatur', 39: 'Daggpunktstemperatur'}
+SMHI_DAILY_PARAMETERS = {5: 'Nederbördsmängd', 19: 'Lufttemperatur'}
+
+
+def _customers(n_customers, rng):
+    customers = pd.DataFrame({
+        'CUSTOMER': 1_000_000_000 + np.sort(rng.choice(999_999_999, n_customers, replace=False)),
+        'AREA': rng.choice(AREAS, n_customers),
+        'ISPRIVATEPERSON': np.where(rng.random(n_customers) < 0.85, 'Ja', 'Nej'),
+    })
+    # Residential customers use a few kWh per hour, commercial ones up to about a MWh
+    customers['scale'] = np.where(customers['ISPRIVATEPERSON'] == 'Ja', 0.002, 0.2) * rng.lognormal(0, 0.5, n_customers)
+    return customers
+
+
+def generate_power_file(path, year, customers, rng, last_year=False, nan_rate=0.02, outlier_rate=0.001, chunk_days=31):
+    # One yearly meter file, one row per customer and day, written a month at a time
+    days = pd.date_range(f'{year}-01-01', f'{year}-12-31', freq='D')
+    prefix = 'VALUE_' if last_year else 'HOUR_'
+    date_column = 'ID_FROM_DATE' if last_year else 'DATE'
+    daily_shape = 1 + 0.5 * np.sin((np.arange(24) - 6) / 24 * 2 * np.pi)
+
+    header = True
+    for start in range(0, len(days), chunk_days):
+        block_days = days[start:start + chunk_days]
+        n = len(block_days) * len(customers)
+        rows = pd.DataFrame({
+            'CUSTOMER': np.tile(customers['CUSTOMER'].to_numpy(), len(block_days)),
+            'AREA': np.tile(customers['AREA'].to_numpy(), len(block_days)),
+            'ISPRIVATEPERSON': np.tile(customers['ISPRIVATEPERSON'].to_numpy(), len(block_days)),
+            date_column: np.repeat(block_days.strftime('%Y-%m-%d'), len(customers)),
+        })
+
+        scale = np.tile(customers['scale'].to_numpy(), len(block_days))[:, None]
+        values = scale * daily_shape * rng.gamma(4, 0.25, (n, 24))
+        values[rng.random((n, 24)) < nan_rate] = np.nan
+        outliers = rng.random((n, 24)) < outlier_rate
+        values[outliers] = rng.choice([-1.0, 1000.0], outliers.sum()) * scale.repeat(24, axis=1)[outliers]
+
+        rows = pd.concat([rows, pd.DataFrame(values.round(6), columns=[f'{prefix}{i}' for i in range(24)])], axis=1)
+        rows.to_csv(path, mode='w' if header else 'a', header=header, index=False, encoding='ISO-8859-1')
+        header = False
+
+
+def generate_price_file(path, year, rng):
+    # Hourly prices as written by get_electricity_prices_utilitarian.py
+    hours = pd.date_range(f'{year}-01-01', f'{year}-12-31 23:00', freq='h', tz='UTC')
+    prices = 50 + 30 * np.sin(np.arange(len(hours)) / 24 * 2 * np.pi) + rng.gamma(2, 20, len(hours))
+    pd.DataFrame({'timestamp_utc': hours.astype(str), 'EUR_per_MWh': prices.round(2)}).to_csv(path)
+
+
+def generate_smhi_file(path, parameter, years, rng):
+    # A Weather_P{parameter}_full.csv as downloaded from the SMHI Open API: a metadata block, then the
+    # semicolon separated data with the trailing description columns
+    metadata = ('Stationsnamn;Stationsnummer;Stationsnät;Mäthöjd (meter över marken)\n'
+                'Kalmar Flygplats;66420;SMHIs stationsnät;2.0\n\n'
+                'Parameternamn;Beskrivning;Enhet\n'
+                f'Parameter {parameter};Syntetisk data;-\n\n')
+
+    if parameter in SMHI_DAILY_PARAMETERS:
+        days = pd.date_range(f'{min(years)}-01-01', f'{max(years)}-12-31', freq='D')
+        data = pd.DataFrame({
+            'Från Datum Tid (UTC)': (days - pd.Timedelta('18h')).strftime('%Y-%m-%d %H:%M:%S'),
+            'Till Datum Tid (UTC)': (days + pd.Timedelta('6h')).strftime('%Y-%m-%d %H:%M:%S'),
+            'Representativt dygn': days.strftime('%Y-%m-%d'),
+            SMHI_DAILY_PARAMETERS[parameter]: rng.normal(8, 6, len(days)).round(1),
+        })
+    else:
+        hours = pd.date_range(f'{min(years)}-01-01', f'{max(years)}-12-31 23:00', freq='h')
+        data = pd.DataFrame({
+            'Datum': hours.strftime('%Y-%m-%d'),
+            'Tid (UTC)': hours.strftime('%H:%M:%S'),
+            SMHI_PARAMETERS[parameter]: rng.normal(8, 6, len(hours)).round(1),
+        })
+    data['Kvalitet'] = 'G'
+    data[''] = ''
+    data['Tidsutsnitt:'] = ''
+
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(metadata)
+        data.to_csv(file, sep=';', index=False)
+
+
+def generate_dataset(output_dir, n_customers=100, years=(2020, 2021, 2022, 2023), weather_parameters=None, seed=0):
+    # Write lnu_YYYY.csv and electricity_prices_YYYY.csv to output_dir and Weather_P{p}_full.csv next to
+    # them. Returns the paths of the meter files. Rows per meter file = n_customers * days in the year
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    customers = _customers(n_customers, rng)
+    weather_parameters = [4, 5, 6, 7, 19, 26, 27, 39] if weather_parameters is None else weather_parameters
+
+    power_paths = []
+    for year in years:
+        path = os.path.join(output_dir, f'lnu_{year}.csv')
+        generate_power_file(path, year, customers, rng, last_year=year == max(years))
+        generate_price_file(os.path.join(output_dir, f'electricity_prices_{year}.csv'), year, rng)
+        power_paths.append(path)
+
+    for parameter in weather_parameters:
+        generate_smhi_file(os.path.join(output_dir, f'Weather_P{parameter}_full.csv'), parameter, years, rng)
+
+    return power_paths
+
+
+def customers_for_rows(n_rows, years=(2020, 2021, 2022, 2023)):
+    # Number of customers giving about n_rows daily meter rows over the given years
+    days = sum(len(pd.date_range(f'{year}-01-01', f'{year}-12-31', freq='D')) for year in years)
+    return max(1, int(round(n_rows / days)))
@@ -0,0 +1,312 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import time
+import numpy as np
+import pandas as pd
+
+from utils import KEfeatures, KEschema
+
+# Fit one forecaster per group (AREA, customer type, customer, ...) in parallel worker processes. Every group
+# gets the daily frame the notebooks use (power summed, Price and dew point averaged) and is evaluated
+# on its last test_size days. Each finished group is written to <output_dir>/<group file>.json (status and
+# metrics), .pkl (fitted model) and .window.parquet (the test days, used by KEforecast), so rerunning the
+# same call skips the groups that are already done.
+# A group that raises, runs past its timeout or takes its worker down is recorded as failed without
+# affecting the others
+
+logger = logging.getLogger(__name__)
+
+
+def _mape(y_true, y_pred):
+    return np.mean(np.abs((y_true - y_pred) / y_true)) * 100
+
+
+def forecast_metrics(y_true, y_pred):
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    mse = np.mean((y_true - y_pred) ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mape = _mape(y_true, y_pred)
+    return {'MSE': mse, 'RMSE': np.sqrt(mse), 'MAE': np.mean(np.abs(y_true - y_pred)), 'MAPE': mape}
+
+
+# Model families. Each takes the daily train and test frames plus its parameters and returns the
+# fitted model and the predictions for the test days. The libraries are imported only when used
+
+def fit_sarimax(train, test, params):
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+    exog = params.get('exog')
+    model = SARIMAX(train[KEfeatures.TARGET], order=params.get('order', (0, 1, 1)),
+                    seasonal_order=params.get('seasonal_order', (1, 1, 1, 7)),
+                    exog=train[exog] if exog else None)
+    model_fit = model.fit(disp=False)
+    predictions = model_fit.predict(len(train), len(train) + len(test) - 1, exog=test[exog] if exog else None)
+    return model_fit, np.asarray(predictions)
+
+
+def fit_xgboost(train, test, params):
+    import xgboost as xgb
+
+    features = params.get('features', KEfeatures.EXOGENOUS)
+    model = xgb.XGBRegressor(**params.get('model_params', {'learning_rate': 0.1, 'max_depth': 1, 'min_child_weight': 3,
+                                                           'n_estimators': 500, 'n_jobs': 1}))
+    model.fit(train[features], train[KEfeatures.TARGET])
+    return model, model.predict(test[features])
+
+
+def fit_random_forest(train, test, params):
+    from sklearn.ensemble import RandomForestRegressor
+
+    features = params.get('features', KEfeatures.EXOGENOUS)
+    model = RandomForestRegressor(**params.get('model_params', {'max_depth': 5, 'min_samples_leaf': 2,
+                                                                'n_estimators': 50, 'n_jobs': 1}))
+    model.fit(train[features].fillna(0), train[KEfeatures.TARGET])
+    return model, model.predict(test[features].fillna(0))
+
+
+def fit_prophet(train, test, params):
+    from prophet import Prophet
+
+    regressors = params.get('regressors', [])
+    model = Prophet(**params.get('model_params', {}))
+    for regressor in regressors:
+        model.add_regressor(regressor)
+
+    to_prophet = lambda df: df.rename(columns={KEfeatures.TARGET: 'y'}).rename_axis('ds').reset_index()
+    model.fit(to_prophet(train)[['ds', 'y'] + regressors])
+    forecast = model.predict(to_prophet(test)[['ds'] + regressors])
+    return model, forecast['yhat'].to_numpy()
+
+
+def fit_cnn(train, test, params):
+    from tensorflow.keras.layers import Conv1D, Dense, Flatten, MaxPooling1D
+    from tensorflow.keras.models import Sequential
+
+    # Same network as KE_CNN, one-step-ahead predictions over the test days on min-max scaled data
+    look_back = params.get('look_back', 10)
+    features = [KEfeatures.TARGET] + params.get('features', [])
+    series = pd.concat([train, test])[features]
+    low, high = series.min(), series.max()
+    scaled = (series - low) / (high - low).replace(0, 1)
+
+    X, y = KEfeatures.create_dataset(scaled, KEfeatures.TARGET, features, look_back)
+    n_test = len(test)
+    model = Sequential()
+    model.add(Conv1D(filters=64, kernel_size=2, activation='relu', input_shape=(look_back, len(features))))
+    model.add(MaxPooling1D(pool_size=2))
+    model.add(Flatten())
+    model.add(Dense(50, activation='relu'))
+    model.add(Dense(1))
+    model.compile(optimizer='adam', loss='mse')
+    model.fit(np.array(X[:-n_test]), y[:-n_test], epochs=params.get('epochs', 200), verbose=0)
+
+    predictions = model.predict(np.array(X[-n_test:]), verbose=0).ravel()
+    target_range = high[KEfeatures.TARGET] - low[KEfeatures.TARGET]
+    return model, predictions * (target_range or 1) + low[KEfeatures.TARGET]
+
+
+MODEL_FAMILIES = {
+    'sarimax': fit_sarimax,
+    'xgboost': fit_xgboost,
+    'random_forest': fit_random_forest,
+    'prophet': fit_prophet,
+    'cnn': fit_cnn,
+}
+
+
+def group_file_name(group):
+    # Readable and filesystem safe name for a group key, with a hash to keep it unique
+    group = group if isinstance(group, tuple) else (group,)
+    label = '_'.join(str(part) for part in group)
+    safe = ''.join(character if character.isalnum() or character in '-.' else '_' for character in label)[:60]
+    return f"{safe}_{hashlib.sha1(repr(group).encode('utf-8')).hexdigest()[:8]}"
+
+
+def data_hash(df):
+    return hashlib.sha256(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes()).hexdigest()[:16]
+
+
+def _fit_key(daily, model, params, test_size):
+    # Identifies the inputs of one group's fit, the daily frame (with its feature columns), the
+    # model and its parameters, so a saved result is only reused for the same settings and data
+    payload = json.dumps([data_hash(daily), model, params, test_size], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:20]
+
+
+def _remove_outputs(output_path):
+    for suffix in ['.json', '.pkl', '.window.parquet']:
+        if os.path.exists(output_path + suffix):
+            os.remove(output_path + suffix)
+
+
+def _write_result(output_path, result):
+    with open(output_path + '.json.tmp', 'w', encoding='utf-8') as file:
+        json.dump(result, file, default=float)
+    os.replace(output_path + '.json.tmp', output_path + '.json')
+
+
+def _group_label(group):
+    return list(group) if isinstance(group, tuple) else [group]
+
+
+def _fit_group(group, daily, model, params, test_size, output_path, key):
+    # Runs in its own worker process and leaves the result in output_path.json. The timeout is
+    # enforced by train_groups, which kills the process, so fits stuck in C code are stopped too
+    started = time.perf_counter()
+    result = {'group': _group_label(group), 'model': model, 'key': key, 'rows': len(daily)}
+    try:
+        if len(daily) <= test_size:
+            raise ValueError(f'Only {len(daily)} days, need more than test_size={test_size}')
+        train, test = daily.iloc[:-test_size], daily.iloc[-test_size:]
+        fitted, predictions = MODEL_FAMILIES[model](train, test, params)
+        result.update(status='ok', **forecast_metrics(test[KEfeatures.TARGET], predictions))
+        with open(output_path + '.pkl', 'wb') as file:
+            pickle.dump(fitted, file)
+        # The days after the training data, which the forecast service appends to the model state
+        test.to_parquet(output_path + '.window.parquet')
+    except Exception as error:
+        result.update(status='failed', error=f'{type(error).__name__}: {error}')
+
+    result['seconds'] = time.perf_counter() - started
+    _write_result(output_path, result)
+
+
+def _finish_group(process, group, model, key, rows, output_path, started, error=None):
+    # Result of a finished or killed worker. A worker that died without writing one (e.g. out of
+    # memory) is recorded as failed like a fit that raised
+    process.join()
+    if error is None and os.path.exists(output_path + '.json'):
+        with open(output_path + '.json', 'r', encoding='utf-8') as file:
+            return json.load(file)
+    result = {'group': _group_label(group), 'model': model, 'key': key, 'rows': rows, 'status': 'failed',
+              'error': error or f'Worker exited with code {process.exitcode}',
+              'seconds': time.perf_counter() - started}
+    _write_result(output_path, result)
+    return result
+
+
+def available_features(long_df, features=None):
+    # The exogenous columns to aggregate per day. By default those of KEfeatures.EXOGENOUS present in long_df,
+    # none for the cleaned long data of reshape_power_df, Price and dew point for the merged final_df.
+    # Features asked for explicitly must all be there
+    if features is None:
+        return [feature for feature in KEfeatures.EXOGENOUS if feature in long_df.columns]
+    missing = [feature for feature in features if feature not in long_df.columns]
+    if missing:
+        raise ValueError(f'Columns {missing} are not in the data, they come from merge_weather_price (the final_df)')
+    return list(features)
+
+
+def _required_features(model, params):
+    # Columns each model family reads from the daily frame, see the fit_* functions
+    if model in ('xgboost', 'random_forest'):
+        return params.get('features', KEfeatures.EXOGENOUS)
+    return {'sarimax': params.get('exog'), 'prophet': params.get('regressors'),
+            'cnn': params.get('features')}.get(model) or []
+
+
+def group_daily_frames(long_df, group_by, features=None):
+    # One daily model frame per group, built with a single groupby over the long data
+    features = available_features(long_df, features)
+    for group, group_df in long_df.groupby(group_by, observed=True, sort=True):
+        yield group, KEfeatures.daily_model_frame(group_df, features)
+
+
+def largest_customers(long_df, n=100, customer_type='Nej'):
+    # The n customers of a type with the highest total consumption, e.g. to train per large commercial customer
+    customers = long_df[KEschema.is_private(long_df['ISPRIVATEPERSON']) == (customer_type == 'Ja')]
+    return customers.groupby('CUSTOMER')['Power_Consumption'].sum().nlargest(n).index
+
+
+def train_groups(long_df, group_by, model='sarimax', params=None, output_dir='data/models', test_size=60,
+                 max_workers=None, timeout=600, features=None, retry_failed=False):
+    # Fit `model` for every group of long_df and return the metrics table. long_df is the cleaned long data
+    # (reshape_power_df) or the merged final_df (merge_weather_price), the models using Price and dew
+    # point (xgboost and random_forest by default) need the latter. Groups that already have a result in
+    # output_dir/<model> for the same data, params and test_size are not fitted again, failed ones only
+    # when retry_failed is set. A result of other settings is replaced, model file included
+    params = params or {}
+    features = available_features(long_df, features)
+    missing = [feature for feature in _required_features(model, params) if feature not in features]
+    if missing:
+        raise ValueError(f'{model} needs the columns {missing}, pass the final_df of merge_weather_price '
+                         f'or choose the features in params')
+    run_dir = os.path.join(output_dir, model)
+    os.makedirs(run_dir, exist_ok=True)
+
+    results = []
+
+    def pending_groups():
+        # Groups still to fit, their daily frames are only built when a worker is free
+        for group, daily in group_daily_frames(long_df, group_by, features):
+            output_path = os.path.join(run_dir, group_file_name(group))
+            key = _fit_key(daily, model, params, test_size)
+            if os.path.exists(output_path + '.json'):
+                with open(output_path + '.json', 'r', encoding='utf-8') as file:
+                    previous = json.load(file)
+                if previous.get('key') == key and (previous['status'] == 'ok' or not retry_failed):
+                    results.append(previous)
+                    continue
+                _remove_outputs(output_path)
+            yield group, daily, output_path, key
+
+    # One process per group, at most max_workers at a time. Killing a process is the only way to stop a
+    # fit blocked inside statsmodels or sklearn, so the timeout is checked here and not in the worker
+    max_workers = max_workers or os.cpu_count() or 1
+    context = multiprocessing.get_context()
+    running = {}
+    pending = pending_groups()
+    try:
+        while True:
+            while len(running) < max_workers:
+                task = next(pending, None)
+                if task is None:
+                    break
+                group, daily, output_path, key = task
+                process = context.Process(target=_fit_group,
+                                          args=(group, daily, model, params, test_size, output_path, key))
+                process.start()
+                running[process.sentinel] = (process, group, key, len(daily), output_path, time.perf_counter())
+            if not running:
+                break
+
+            wait_seconds = None
+            if timeout:
+                oldest = min(started for *_, started in running.values())
+                wait_seconds = max(0.0, oldest + timeout - time.perf_counter())
+            finished = multiprocessing.connection.wait(list(running), wait_seconds)
+
+            for sentinel in list(running):
+                process, group, key, rows, output_path, started = running[sentinel]
+                if sentinel in finished:
+                    result = _finish_group(process, group, model, key, rows, output_path, started)
+                elif timeout and time.perf_counter() - started >= timeout:
+                    process.kill()
+                    result = _finish_group(process, group, model, key, rows, output_path, started,
+                                           f'TimeoutError: Fit exceeded its timeout of {timeout}s')
+                else:
+                    continue
+                del running[sentinel]
+                logger.info('%s: %s in %.1fs', result['group'], result['status'], result['seconds'])
+                results.append(result)
+    finally:
+        # Interrupted (e.g. Ctrl-C): stop the workers, the finished groups are on disk
+        for process, *_ in running.values():
+            process.kill()
+            process.join()
+
+    metrics = pd.DataFrame(results)
+    if len(metrics):
+        metrics.to_csv(os.path.join(run_dir, 'metrics.csv'), index=False)
+    return metrics
+
+
+def load_group_model(group, model='sarimax', output_dir='data/models'):
+    with open(os.path.join(output_dir, model, group_file_name(group) + '.pkl'), 'rb') as file:
+        return pickle.load(file)
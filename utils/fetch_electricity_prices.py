@@ -0,0 +1,153 @@
+import argparse
+import asyncio
+import csv
+import logging
+import random
+from datetime import date, datetime, timedelta
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Shared fetcher for both price sources. All days and regions are requested concurrently over one
+# pooled async client, failed requests are retried with exponential backoff, and every day is
+# appended to the output CSV as soon as it arrives instead of being collected in memory.
+# A day that still fails after all retries is reported at the end without losing the rest.
+
+
+def _elprisetjustnu_url(day, region):
+    return f"https://www.elprisetjustnu.se/api/v1/prices/{day.year}/{day.month:02d}-{day.day:02d}_{region}.json"
+
+
+def _elprisetjustnu_rows(data, region):
+    # Same layout as get_electricity_prices.py: 'time_start' becomes 'timestamp', 'time_end' is dropped
+    rows = []
+    for item in data:
+        row = {'region': region, **item}
+        row['timestamp'] = row.pop('time_start', None)
+        row.pop('time_end', None)
+        rows.append(row)
+    return rows
+
+
+def _utilitarian_url(day, region):
+    # Time is in UTC and prices are in €/MWh
+    return f"https://spot.utilitarian.io/electricity/{region}/{day.year}/{day.month:02d}/{day.day:02d}/"
+
+
+def _utilitarian_rows(data, region):
+    return [{'region': region, **item} for item in data]
+
+
+SOURCES = {
+    'elprisetjustnu': (_elprisetjustnu_url, _elprisetjustnu_rows),
+    'utilitarian': (_utilitarian_url, _utilitarian_rows),
+}
+
+# Responses worth another try, anything else non-200 fails the day straight away
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _days(start_date, end_date):
+    day = start_date
+    while day <= end_date:
+        yield day
+        day += timedelta(days=1)
+
+
+class _CsvStream:
+    # Append rows to a CSV file, taking the header from the first row
+    def __init__(self, file):
+        self.file = file
+        self.writer = None
+        self.rows = 0
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames=list(rows[0]), extrasaction='ignore')
+            self.writer.writeheader()
+        self.writer.writerows(rows)
+        self.file.flush()
+        self.rows += len(rows)
+
+
+async def _fetch_day(client, semaphore, url, retries, backoff):
+    for attempt in range(retries + 1):
+        async with semaphore:
+            try:
+                response = await client.get(url)
+            except httpx.TransportError as error:
+                if attempt == retries:
+                    raise
+                failure = error
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                    raise Exception(f"Failed to fetch {url}: status code {response.status_code}")
+                failure = response.status_code
+
+        # Back off outside the semaphore so other requests can use the slot
+        await asyncio.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+    raise Exception(f"Failed to fetch {url}: {failure}")
+
+
+async def fetch_prices(regions, start_date, end_date, output_path, source='elprisetjustnu', concurrency=8,
+                       retries=4, backoff=0.5, timeout=30, transport=None):
+    # Fetch every day from start_date to end_date (inclusive, 'YYYY-MM-DD' or date) for every region.
+    # transport can be any httpx transport, e.g. httpx.MockTransport or one pointing at a local stub server.
+    # Returns the number of rows written and the (region, day, error) of days that failed
+    url_for, rows_for = SOURCES[source]
+    if isinstance(start_date, str):
+        start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+    if isinstance(end_date, str):
+        end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    failures = []
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout, follow_redirects=True, transport=transport) as client:
+        async def fetch(day, region):
+            try:
+                data = await _fetch_day(client, semaphore, url_for(day, region), retries, backoff)
+            except Exception as error:
+                return day, region, None, error
+            return day, region, data, None
+
+        with open(output_path, 'w', encoding='utf-8', newline='') as file:
+            stream = _CsvStream(file)
+            tasks = [asyncio.ensure_future(fetch(day, region)) for day in _days(start_date, end_date) for region in regions]
+            for task in asyncio.as_completed(tasks):
+                day, region, data, error = await task
+                if error is not None:
+                    failures.append((region, day.isoformat(), str(error)))
+                    logger.warning("Failed to fetch data for region %s on %s: %s", region, day, error)
+                    continue
+                stream.write(rows_for(data, region))
+
+    return stream.rows, failures
+
+
+def fetch_prices_for_years(regions, years, output_path, **kwargs):
+    # Blocking wrapper fetching the calendar years from min(years) to max(years), e.g. (['SE1', 'SE2', 'SE3', 'SE4'], [2022, 2023])
+    return asyncio.run(fetch_prices(regions, date(min(years), 1, 1), date(max(years), 12, 31), output_path, **kwargs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch hourly electricity prices for several regions and years.')
+    parser.add_argument('--source', choices=sorted(SOURCES), default='elprisetjustnu')
+    parser.add_argument('--regions', nargs='+', default=['SE4'])
+    parser.add_argument('--years', nargs='+', type=int, default=[2023])
+    parser.add_argument('--output', default='data/electricity_prices.csv')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--retries', type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    rows, failures = fetch_prices_for_years(args.regions, args.years, args.output, source=args.source,
+                                            concurrency=args.concurrency, retries=args.retries)
+    logger.info("Wrote %s rows to %s, %s failed days", rows, args.output, len(failures))
@@ -1,11 +1,13 @@
+import logging
 import requests
 import pandas as pd
-from io import StringIO
-import re
+from concurrent.futures import ProcessPoolExecutor
 
 # Define the parameters and years you want to process
 parameters = [4, 5, 6, 7, 19, 26, 27, 39]  # Updated parameters list
 years = [2020, 2021, 2022, 2023]
+logger = logging.getLogger(__name__)
+
 station_id = "66420"  # Assuming you are using the same station for all parameters and this station id means Kalmar
 
 # Base URL for SMHI Open API
@@ -43,90 +45,106 @@ def fetch_and_save_csv(parameter):
         csv_filename = f'Weather_P{parameter}_full.csv'
         with open(csv_filename, 'w', encoding='utf-8') as file:
             file.write(content)
-        print(f'Saved CSV for parameter {parameter}.')
+        logger.info('Saved CSV for parameter %s.', parameter)
     else:
-        print(f'Failed to fetch data for parameter {parameter}. Status code: {response.status_code}')
-
-def find_header_row(file_name):
-    with open(file_name, 'r', encoding='utf-8') as file:
-        for i, line in enumerate(file):
-            # Check if 'Datum' or 'Från Datum' is in the line
-            if 'Datum' in line or 'Från Datum' in line:
-                return i
-    return None  # If a header row wasn't found, return None
+        logger.warning('Failed to fetch data for parameter %s. Status code: %s', parameter, response.status_code)
 
 
 # Function to process the CSV file for a specific year
 def process_csv(parameter, year):
+    process_parameter(parameter, [year], write_csv=True)
+
+
+# Read the full CSV for a parameter once. The metadata block above the header row is skipped
+# while reading, so the file is not scanned twice
+def read_parameter_csv(parameter):
     csv_filename = f'Weather_P{parameter}_full.csv'
-    
-    # Find the header row
-    header_row = find_header_row(csv_filename)
-    
-    # Load the dataset
-    df = pd.read_csv(csv_filename, delimiter=';', encoding='utf-8', skiprows=header_row, low_memory=False)
-    
+
+    with open(csv_filename, 'r', encoding='utf-8') as file:
+        while True:
+            position = file.tell()
+            line = file.readline()
+            if not line:
+                # No header row found, read the file from the top
+                position = 0
+                break
+            # Check if 'Datum' or 'Från Datum' is in the line
+            if 'Datum' in line or 'Från Datum' in line:
+                break
+        file.seek(position)
+
+        return pd.read_csv(file, delimiter=';', low_memory=False)
+
+
+# Parameter-specific column handling, with the time part taken out by vectorized string operations
+def tidy_parameter_frame(df, parameter):
     # Rename the columns as specified
     df = df.rename(columns=column_names_mapping)
-    
-    # Handle parameter-specific columns and conversions
+
+    # Time part of the 'From'/'To Date Time (UTC)' columns of parameters 5 and 19
+    time_part = r'\d{4}-\d{2}-\d{2}\s(\d{2}:\d{2}:\d{2})'
+
     if parameter == 5:
-        # Define the regex pattern for the time part
-        time_pattern = re.compile(r'(?<=\d{4}-\d{2}-\d{2}\s)\d{2}:\d{2}:\d{2}')
-        # Extract the time part and assign it to a new column called 'Time'
-        df['Time'] = df['From Date Time (UTC)'].astype(str).apply(lambda x: time_pattern.search(x).group(0) if time_pattern.search(x) else '')
+        df['Time'] = df['From Date Time (UTC)'].astype(str).str.extract(time_part, expand=False).fillna('')
         df['Date'] = pd.to_datetime(df['Representative Date'], errors='coerce')
         df = df[['Date', 'Time', 'Precipitation', 'Quality']]
     elif parameter == 6:
-        # For parameter 6, the 'Time' column should already exist
-        df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
         df = df[['Date', 'Time', 'Relative Humidity', 'Quality']]
     elif parameter == 7:
-        # For parameter 7, the 'Time' column should already exist
-        df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
         df = df[['Date', 'Time', 'Precipitation', 'Quality']]
     elif parameter == 19:
-        # Define the regex pattern for the time part
-        time_pattern = re.compile(r'(?<=\d{4}-\d{2}-\d{2}\s)\d{2}:\d{2}:\d{2}')
-        # Extract the time part and assign it to a new column called 'Time'
-        df['Time'] = df['To Date Time (UTC)'].astype(str).apply(lambda x: time_pattern.search(x).group(0) if time_pattern.search(x) else '')
+        df['Time'] = df['To Date Time (UTC)'].astype(str).str.extract(time_part, expand=False).fillna('')
         df['Date'] = pd.to_datetime(df['Representative Date'], errors='coerce')
-        df.rename(columns={'Air Temperature': 'Air Temperature 1 Min'}, inplace=True)
+        df = df.rename(columns={'Air Temperature': 'Air Temperature 1 Min'})
         df = df[['Date', 'Time', 'Air Temperature 1 Min', 'Quality']]
     elif parameter == 26:
-        df.rename(columns={'Air Temperature': 'Air Temperature 2 Min'}, inplace=True)
+        df = df.rename(columns={'Air Temperature': 'Air Temperature 2 Min'})
         df = df[['Date', 'Time', 'Air Temperature 2 Min', 'Quality']]
     elif parameter == 27:
-        df.rename(columns={'Air Temperature': 'Air Temperature 2 Max'}, inplace=True)
+        df = df.rename(columns={'Air Temperature': 'Air Temperature 2 Max'})
         df = df[['Date', 'Time', 'Air Temperature 2 Max', 'Quality']]
     elif parameter == 39:
-        # For parameter 39, use 'Dew Point temperature' column
-        df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
         df = df[['Date', 'Time', 'Dew Point Temperature', 'Quality']]
     else:  # For parameter 4 and any other parameters
-        df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
-        df['Wind Speed'] = df.get('Wind Speed', None)  # Get 'Wind Speed' if it exists, else fill with None
+        df = df.assign(**{'Wind Speed': df.get('Wind Speed', None)})
         df = df[['Date', 'Time', 'Wind Speed', 'Quality']]
 
     # Ensure the 'Date' column is in datetime format
-    df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
-    
-    # Now that 'Date' is a datetime object, filter the DataFrame by the specified year
-    df = df[df['Date'].dt.year == year]
-    
-    # Save the processed DataFrame to a CSV file
-    processed_file_name = f'weather_P{parameter}_{year}_processed.csv'
-    df.to_csv(processed_file_name, index=False, sep=';', encoding='utf-8')
-    print(f'Processed and saved {processed_file_name}')
+    df = df.assign(Date=pd.to_datetime(df['Date'], errors='coerce'))
+
+    return df
 
-# Main loop to fetch and process the data
-for parameter in parameters:
-    fetch_and_save_csv(parameter)  # Fetch the full dataset for each parameter
 
+# Read a parameter once and split it by year in memory. The per-year CSVs are only written
+# when write_csv is set. Returns {year: DataFrame}
+def process_parameter(parameter, years, write_csv=False):
+    df = tidy_parameter_frame(read_parameter_csv(parameter), parameter)
+
+    yearly = {}
+    date_years = df['Date'].dt.year
     for year in years:
-        process_csv(parameter, year)  # Process data for each year
-        
-        
-        
-        
+        yearly[year] = df[date_years == year]
+
+        if write_csv:
+            processed_file_name = f'weather_P{parameter}_{year}_processed.csv'
+            yearly[year].to_csv(processed_file_name, index=False, sep=';', encoding='utf-8')
+            logger.info('Processed and saved %s', processed_file_name)
+
+    return yearly
+
+
+# Process all parameters in parallel, one worker per parameter. Returns {parameter: {year: DataFrame}}
+def process_all_parameters(parameters, years, write_csv=False, max_workers=None):
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(process_parameter, parameters, [years] * len(parameters), [write_csv] * len(parameters))
+        return dict(zip(parameters, results))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Fetch the full dataset for each parameter, then process them all in parallel
+    for parameter in parameters:
+        fetch_and_save_csv(parameter)
 
+    process_all_parameters(parameters, years, write_csv=True)
@@ -1,57 +1,114 @@
+import logging
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 # Define your parameters and years
 parameters = [4, 6, 7, 19, 26, 27, 39]
 years = [2020, 2021, 2022, 2023]
 
-# Step 1: Combine CSVs for each parameter across all years
-for parameter in parameters:
+# Parameters with one value per day (stamped at the end of the observation window), all
+# others are hourly
+daily_parameters = [5, 19]
+
+
+# Load one parameter as a Series indexed by its UTC 'DateTime', either from the per-year
+# processed CSVs or from the in-memory frames of get_weather_parameters.process_parameter
+def load_parameter_series(parameter, years, yearly_frames=None):
     # List to hold data for each year for the current parameter
     yearly_data = []
-    
+
     for year in years:
-        file_name = f'weather_P{parameter}_{year}_processed.csv'
-        try:
-            # Read the CSV file
-            df = pd.read_csv(file_name, delimiter=';', encoding='utf-8')
-            # Create 'DateTime' column and drop 'Date' and 'Time' columns
-            df['DateTime'] = pd.to_datetime(df['Date'] + ' ' + df['Time'])
-            df.drop(['Date', 'Time', 'Quality'], axis=1, inplace=True)  # Exclude 'Quality' column as well
-            # Append to the yearly data list
-            yearly_data.append(df)
-        except FileNotFoundError:
-            print(f"File {file_name} not found. Skipping.")
-    
-    # Combine yearly data for the current parameter
-    parameter_data = pd.concat(yearly_data, ignore_index=True)
-    # Save combined data for the current parameter to a CSV
-    parameter_data.to_csv(f'combined_P{parameter}.csv', index=False, sep=';', encoding='utf-8')
-
-# Step 2: Merge all parameters into one final CSV
-# List to hold the combined data from each parameter
-all_parameters_data = []
-
-for parameter in parameters:
-    try:
-        # Read the combined CSV for the parameter
-        df = pd.read_csv(f'combined_P{parameter}.csv', delimiter=';', encoding='utf-8')
-        # Rename all columns except for 'DateTime' to include the parameter number
-        df.rename(columns={col: f"{col}_P{parameter}" for col in df.columns if col != 'DateTime'}, inplace=True)
-        # Append to the all parameters data list
-        all_parameters_data.append(df)
-    except FileNotFoundError:
-        print(f"Combined CSV for parameter {parameter} not found. Skipping.")
-
-# Combine all parameter data into one DataFrame
-final_data = pd.concat(all_parameters_data, ignore_index=True)
-
-# Pivot to get one unique 'DateTime' per row
-final_data_pivot = final_data.pivot_table(index='DateTime', aggfunc='first').reset_index()
-
-# Sort by 'DateTime'
-final_data_pivot.sort_values(by='DateTime', inplace=True)
-
-# Save the final pivoted data to a CSV
-final_data_pivot.to_csv('final_combined_weather_data.csv', index=False, sep=';', encoding='utf-8')
-
-print("Finished combining all parameter data.")
+        if yearly_frames is not None:
+            df = yearly_frames[year].copy()
+            df['Date'] = df['Date'].dt.strftime('%Y-%m-%d')
+        else:
+            file_name = f'weather_P{parameter}_{year}_processed.csv'
+            try:
+                # Read the CSV file
+                df = pd.read_csv(file_name, delimiter=';', encoding='utf-8')
+            except FileNotFoundError:
+                logger.warning("File %s not found. Skipping.", file_name)
+                continue
+
+        # Create 'DateTime' column and drop 'Date' and 'Time' columns
+        df['DateTime'] = pd.to_datetime(df['Date'] + ' ' + df['Time'])
+        df = df.drop(['Date', 'Time', 'Quality'], axis=1)  # Exclude 'Quality' column as well
+        yearly_data.append(df)
+
+    if not yearly_data:
+        return None
+
+    # Combine yearly data and name the value column after the parameter number
+    parameter_data = pd.concat(yearly_data, ignore_index=True).set_index('DateTime')
+    series = parameter_data.iloc[:, 0].rename(f"{parameter_data.columns[0]}_P{parameter}")
+
+    return series.dropna()
+
+
+# Put one parameter on the canonical hourly index. Sub-hourly values are resampled to the
+# first value of each hour, daily values are either left at their own hour only ('none', the
+# table the script has always written) or forward-filled over the following hours until the
+# next daily value ('ffill'). 'ffill' changes final_combined_weather_data.csv and every final_df
+# merged from it, so it is opt in
+def align_to_hours(series, hourly_index, daily=False, daily_fill='none'):
+    series = series[~series.index.duplicated(keep='first')].sort_index()
+    series = series.resample('h').first().dropna()
+
+    if daily and daily_fill == 'ffill':
+        return series.reindex(hourly_index, method='ffill', limit=23)
+
+    return series.reindex(hourly_index)
+
+
+# Merge parameter series side by side on one hourly UTC index from the first to the last
+# observation. Returns the wide table with a 'DateTime' column and a per-column coverage report
+def merge_parameters(parameter_series, daily_fill='none'):
+    start = min(series.index.min() for series in parameter_series.values()).floor('h')
+    end = max(series.index.max() for series in parameter_series.values()).ceil('h')
+    hourly_index = pd.date_range(start, end, freq='h', name='DateTime')
+
+    columns = {}
+    for parameter, series in parameter_series.items():
+        columns[series.name] = align_to_hours(series, hourly_index, parameter in daily_parameters, daily_fill)
+
+    # Same column order the old pivot_table produced
+    wide = pd.DataFrame(columns, index=hourly_index)[sorted(columns)]
+
+    coverage = pd.DataFrame({
+        'parameter': [parameter for parameter in parameter_series],
+        'observations': [len(series) for series in parameter_series.values()],
+        'first': [series.index.min() for series in parameter_series.values()],
+        'last': [series.index.max() for series in parameter_series.values()],
+    }, index=[series.name for series in parameter_series.values()])
+    coverage['hours_filled'] = wide.notna().sum()
+    coverage['coverage'] = coverage['hours_filled'] / len(wide)
+    coverage.index.name = 'column'
+
+    return wide.reset_index(), coverage.sort_index()
+
+
+def merge_weather_parameters(parameters, years, yearly_frames=None, daily_fill='none'):
+    parameter_series = {}
+    for parameter in parameters:
+        frames = None if yearly_frames is None else yearly_frames[parameter]
+        series = load_parameter_series(parameter, years, frames)
+        if series is None:
+            logger.warning("No data for parameter %s. Skipping.", parameter)
+            continue
+        parameter_series[parameter] = series
+
+    return merge_parameters(parameter_series, daily_fill)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    final_data, coverage = merge_weather_parameters(parameters, years)
+
+    # Save the final data to a CSV
+    final_data.to_csv('final_combined_weather_data.csv', index=False, sep=';', encoding='utf-8')
+    coverage.to_csv('weather_coverage_report.csv', sep=';', encoding='utf-8')
+
+    logger.info(coverage)
+    logger.info("Finished combining all parameter data.")